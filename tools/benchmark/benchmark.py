@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+import sys
+import os
+import re
+import ast
+import argparse
+import bisect
+import json
+import random
+import shlex
+import shutil
+import subprocess
+import time
+
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DF_TYPES = ("character", "integer", "decimal", "logical", "date", "datetime", "int64", "recid", "raw", "clob")
+
+
+def zipf_weights(n, skew):
+    """Returns cumulative weights for picking among n items with a Zipf-like skew, 0 meaning uniform.
+    """
+    cum_weights = []
+    total = 0.0
+    for i in range(n):
+        total += 1.0 / ((i + 1) ** skew)
+        cum_weights.append(total)
+    return cum_weights
+
+
+def weighted_pick(rng, cum_weights):
+    """Returns the index of an item picked with the cumulative weights from zipf_weights. Stands in for random.choices, which
+    python3.4 lacks.
+    """
+    return min(bisect.bisect(cum_weights, rng.random() * cum_weights[-1]), len(cum_weights) - 1)
+
+
+def generate_df(rng, tables, max_fields):
+    """Returns the text of a synthetic .df with tables tables of 1 to max_fields fields each, covering every data type, extents,
+    and names that need rewriting for MySQL, plus a unique primary index and up to 2 more indexes per table.
+    """
+    out = []
+    for t in range(tables):
+        table_name = "bench-tbl%d" % t
+        out.append('ADD TABLE "%s"\n  AREA "Data"\n  DESCRIPTION "Benchmark table %d"\n  DUMP-NAME "bench%d"\n' % (table_name, t, t))
+        fields = []
+        for c in range(rng.randint(1, max_fields)):
+            field_name = "%s%d" % (rng.choice(("cust-num", "order", "name", "amt%", "key", "desc")), c)
+            field_type = DF_TYPES[c % len(DF_TYPES)] if c < len(DF_TYPES) else rng.choice(DF_TYPES)
+            lines = ['ADD FIELD "%s" OF "%s" AS %s ' % (field_name, table_name, field_type), '  FORMAT "x(8)"', '  INITIAL ""',
+                     '  POSITION %d' % (c + 2), '  MAX-WIDTH %d' % rng.choice((8, 16, 80))]
+            if (field_type != "clob") and (rng.random() < 0.1):
+                lines.append('  EXTENT %d' % rng.randint(2, 5))
+            if field_type == "decimal":
+                lines.append('  DECIMALS %d' % rng.randint(0, 6))
+            lines.append('  ORDER %d' % (c * 10))
+            out.append("\n".join(lines) + "\n")
+            fields.append(field_name)
+        for ix in range(rng.randint(1, 3)):
+            lines = ['ADD INDEX "bench-ix%d-%d" ON "%s" ' % (t, ix, table_name), '  AREA "Index"']
+            if ix == 0:
+                lines += ['  UNIQUE', '  PRIMARY']
+            for field_name in rng.sample(fields, min(len(fields), rng.randint(1, 3))):
+                lines.append('  INDEX-FIELD "%s" ASCENDING ' % field_name)
+            out.append("\n".join(lines) + "\n")
+    out.append(".\nPSC\ncpstream=ISO8859-1\n.\n0000000000\n")
+    return "\n".join(out)
+
+
+def column_value(rng, column, rec_id):
+    """Returns a value for column shaped like the ones Progress WRITE-JSON produces for its type.
+    """
+    def scalar():
+        if column['type'] in ("integer", "int64", "recid"):
+            return rng.randint(0, 1000000)
+        elif column['type'] == "decimal":
+            return round(rng.uniform(0, 100000), 2)
+        elif column['type'] == "logical":
+            return rng.random() < 0.5
+        elif column['type'] == "date":
+            return "20%02d-%02d-%02d" % (rng.randint(0, 30), rng.randint(1, 12), rng.randint(1, 28))
+        elif column['type'] == "datetime":
+            return "20%02d-%02d-%02dT%02d:%02d:00.000" % (rng.randint(0, 30), rng.randint(1, 12), rng.randint(1, 28),
+                                                          rng.randint(0, 23), rng.randint(0, 59))
+        width = int(column.get('max-width', 16))
+        return ("r%s-" % rec_id + "x" * rng.randint(0, width))[:width]
+    if 'extent' in column:
+        return [scalar() for i in range(int(column['extent']))]
+    return scalar()
+
+
+def generate_workload(rng, ddl, jsondir, files, rows, recids, skew, deletes):
+    """Writes files JSON files named like the trigger and dump programs do into jsondir, returning the number of rows written. Each
+    table's first file is an insert of its first rows, the rest are writes or(with probability deletes) deletes. Tables and rec_ids
+    are picked with a Zipf skew, so a few hot tables and rows take most of the changes, as on a real database.
+    """
+    tables = ddl['tables']
+    table_weights = zipf_weights(len(tables), skew)
+    recid_weights = zipf_weights(recids, skew)
+    epoch = 1600000000000
+    started = set()
+    row_count = 0
+    for i in range(files):
+        table = tables[weighted_pick(rng, table_weights)]
+        epoch += rng.randint(1, 50)
+        if table['name'][0] not in started:
+            op = "insert"
+            rec_ids = range(1, rows + 1)
+            started.add(table['name'][0])
+        elif rng.random() < deletes:
+            op = "delete"
+            rec_ids = [weighted_pick(rng, recid_weights) + 1 for j in range(rows)]
+        else:
+            op = "write"
+            rec_ids = [weighted_pick(rng, recid_weights) + 1 for j in range(rows)]
+        tt = []
+        for rec_id in rec_ids:
+            row = {"rec_id": rec_id, "epoch_time": epoch}
+            if op != "delete":
+                for column in table['columns']:
+                    row[column['name'][0]] = column_value(rng, column, rec_id)
+            tt.append(row)
+        filename = "%s/t__%s__e__%s__%s.json" % (jsondir, table['name'][0], epoch, op)
+        f = open(filename + "_partial", 'w')
+        f.write(json.dumps({"tt": tt}, indent=2))  # WRITE-JSON output is formatted, and so larger than compact JSON
+        f.close()
+        os.rename(filename + "_partial", filename)
+        row_count += len(tt)
+    return row_count
+
+
+def run_stage(name, args, workdir, units, unit_name):
+    """Runs one of the tools with args, returning a dictionary of its wall time, throughput in unit_name per second, peak RSS, and
+    exit status. Output goes to <workdir>/<name>.log. os.wait4() gives the rusage of this child alone(and any children it waited for,
+    such as pool workers), where RUSAGE_CHILDREN would mix every stage together.
+    """
+    log = open("%s/%s.log" % (workdir, name), 'w')
+    started = time.time()
+    proc = subprocess.Popen([sys.executable] + args, stdout=log, stderr=subprocess.STDOUT, cwd=workdir)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - started
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    log.close()
+    stage = {
+        "stage": name,
+        "seconds": round(elapsed, 3),
+        "units": units,
+        "unit_name": unit_name,
+        "throughput": round(units / elapsed, 1) if elapsed > 0 else 0,
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024.0, 1),  # Linux reports KiB
+        "exit": proc.returncode,
+    }
+    if proc.returncode != 0:
+        print("!!! %s exited with %s, see %s/%s.log" % (name, proc.returncode, workdir, name))
+    return stage
+
+
+def best_stage(repeat, name, args, workdir, units, unit_name):
+    """Runs a stage repeat times and returns the fastest run, since a tool that only takes a fraction of a second is otherwise
+    dominated by noise such as interpreter startup and page cache state. Peak RSS is the largest seen over all runs.
+    """
+    runs = [run_stage(name, args, workdir, units, unit_name) for i in range(repeat)]
+    best = min(runs, key=lambda r: r['seconds'])
+    best['peak_rss_mb'] = max([r['peak_rss_mb'] for r in runs])
+    best['exit'] = max([r['exit'] for r in runs], key=abs)
+    return best
+
+
+def engine_latency(logfile):
+    """Returns p50/p99/max of the apply time of each chunk persisted, taken from the `result`s the engine prints.
+    """
+    elapsed = []
+    pattern = re.compile(r'finished persist_row_db, result: (\{.*\})$')
+    f = open(logfile, 'r')
+    for line in f:
+        m = pattern.search(line.rstrip("\n"))
+        if m is not None:
+            elapsed.append(ast.literal_eval(m.group(1))['elapsed'])
+    f.close()
+    if len(elapsed) == 0:
+        return {}
+    elapsed.sort()
+    return {
+        "chunks": len(elapsed),
+        "latency_p50_ms": round(elapsed[int(len(elapsed) * 0.50)] * 1000, 2),
+        "latency_p99_ms": round(elapsed[min(int(len(elapsed) * 0.99), len(elapsed) - 1)] * 1000, 2),
+        "latency_max_ms": round(elapsed[-1] * 1000, 2),
+    }
+
+
+def prepare_mysql(parsed_args, table_sql):
+    """Recreates the benchmark database on the MySQL server and creates its tables from table_sql.
+    """
+    import pymysql
+    conn = pymysql.connect(host=parsed_args['dbhost'], port=parsed_args['dbport'], user=parsed_args['dbuser'], passwd=parsed_args['dbpass'],
+                           charset="utf8", autocommit=True)
+    cur = conn.cursor()
+    cur.execute("DROP DATABASE IF EXISTS " + parsed_args['dbname'])
+    cur.execute("CREATE DATABASE " + parsed_args['dbname'])
+    cur.execute("USE " + parsed_args['dbname'])
+    for statement in table_sql.split(";\n"):
+        if statement.strip() != "":
+            cur.execute(statement)
+    cur.close()
+    conn.close()
+
+
+def print_report(report):
+    print("")
+    print("%-22s %10s %14s %-8s %12s %6s" % ("stage", "seconds", "throughput", "", "peak RSS MB", "exit"))
+    for stage in report['stages']:
+        print("%-22s %10.3f %14.1f %-8s %12.1f %6s" % (stage['stage'], stage['seconds'], stage['throughput'], stage['unit_name'] + "/s",
+                                                       stage['peak_rss_mb'], stage['exit']))
+        if 'latency_p50_ms' in stage:
+            print("%-22s chunk apply latency p50 %sms, p99 %sms, max %sms over %s chunks" % ("", stage['latency_p50_ms'],
+                                                                                             stage['latency_p99_ms'], stage['latency_max_ms'],
+                                                                                             stage['chunks']))
+
+
+def compare_reports(baseline, report, tolerance):
+    """Prints the change of each stage against baseline, returning False if any stage lost more than tolerance percent of its
+    throughput or grew its peak RSS by more than tolerance percent.
+    """
+    ok = True
+    previous = dict([(s['stage'], s) for s in baseline['stages']])
+    print("")
+    print("Compared to baseline (tolerance %s%%):" % tolerance)
+    for stage in report['stages']:
+        if stage['stage'] not in previous:
+            continue
+        before = previous[stage['stage']]
+        throughput_change = ((stage['throughput'] - before['throughput']) / before['throughput'] * 100) if before['throughput'] > 0 else 0
+        rss_change = ((stage['peak_rss_mb'] - before['peak_rss_mb']) / before['peak_rss_mb'] * 100) if before['peak_rss_mb'] > 0 else 0
+        regressed = (throughput_change < -tolerance) or (rss_change > tolerance)
+        print("%-22s throughput %+7.1f%%  peak RSS %+7.1f%%  %s" % (stage['stage'], throughput_change, rss_change,
+                                                                    "REGRESSION" if regressed else "ok"))
+        if regressed:
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ProrepTK tools against a synthetic schema and workload")
+    parser.add_argument("--workdir", type=str, default="/tmp/proreptk_benchmark",
+                        help="scratch directory, emptied at the start of each run (default: /tmp/proreptk_benchmark)")
+    parser.add_argument("--seed", metavar='N', type=int, default=1,
+                        help="random seed, the same seed and sizes always give the same schema and workload (default: 1)")
+    parser.add_argument("--tables", metavar='N', type=int, default=200, help="tables in the synthetic .df (default: 200)")
+    parser.add_argument("--fields", metavar='N', type=int, default=40, help="most fields per table (default: 40)")
+    parser.add_argument("--files", metavar='N', type=int, default=200, help="JSON files in the workload (default: 200)")
+    parser.add_argument("--rows", metavar='N', type=int, default=1000, help="rows per JSON file (default: 1000)")
+    parser.add_argument("--recids", metavar='N', type=int, default=20000,
+                        help="distinct rec_ids per table that writes and deletes pick from (default: 20000)")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for picking tables and rec_ids, 0 is uniform (default: 1.1)")
+    parser.add_argument("--deletes", type=float, default=0.05, help="share of files after a table's first that are deletes (default: 0.05)")
+    parser.add_argument("--repeat", metavar='N', type=int, default=3, help="runs of each tool before the engine, keeping the fastest (default: 3)")
+    parser.add_argument("--ddlformat", type=str, choices=('json', 'pack'), default="pack",
+                        help="DDL format given to the generators and the engine (default: pack)")
+    parser.add_argument("--target", type=str, choices=('mysql', 'sqlite', 'none'), default="mysql",
+                        help="database to run the persistence engine against, 'sqlite' needs no server, 'none' skips it (default: mysql)")
+    parser.add_argument("--engineargs", type=str, default="--processes 4", help="extra arguments for persistence_engine (default: '--processes 4')")
+    parser.add_argument("--dbname", type=str, default="proreptk_benchmark",
+                        help="MySQL database to create for the run, any existing one is DROPPED (default: proreptk_benchmark)")
+    parser.add_argument("--dbhost", type=str, default="127.0.0.1", help="MySQL database hostname/ip (default: 127.0.0.1)")
+    parser.add_argument("--dbport", type=int, default=3306, help="MySQL database port (default: 3306)")
+    parser.add_argument("--dbuser", type=str, default="root", help="MySQL database username (default: root)")
+    parser.add_argument("--dbpass", type=str, default="", help="MySQL database password (default: null)")
+    parser.add_argument("--save", type=str, default="", help="write the report as JSON to this file (default: none)")
+    parser.add_argument("--compare", type=str, default="",
+                        help="compare against a report written by --save, exiting 1 on a regression (default: none)")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="percent of throughput lost or peak RSS gained that --compare reports as a regression (default: 10)")
+    parsed_args = vars(parser.parse_args())
+
+    workdir = parsed_args['workdir']
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir + "/json")
+    os.makedirs(workdir + "/abl")
+    rng = random.Random(parsed_args['seed'])
+    tables = parsed_args['tables']
+    report = {"args": parsed_args, "stages": []}
+
+    print("Generating synthetic .df with %s tables." % tables)
+    f = open(workdir + "/bench.df", 'w', encoding="latin_1")
+    f.write(generate_df(rng, tables, parsed_args['fields']))
+    f.close()
+
+    def ddl_stage(stage, args):
+        report['stages'].append(best_stage(parsed_args['repeat'], stage, [TOOLS_DIR + args[0]] + args[1:], workdir, tables, "tables"))
+
+    ddl_stage("parse_df", ["/parse_df/parse_df.py", "--input", "bench.df", "--output", "intermediate.json"])
+    ddl_stage("customize_ddl_mysql", ["/generate_rdbms_ddl/customize_ddl_mysql.py", "--input", "intermediate.json", "--output", "mysql.json",
+                                      "--dbname", parsed_args['dbname'], "--dbhost", parsed_args['dbhost'],
+                                      "--dbport", str(parsed_args['dbport']), "--dbuser", parsed_args['dbuser']])
+    ddl_file = "mysql.json"
+    if parsed_args['ddlformat'] == "pack":
+        ddl_stage("pack_ddl", ["/generate_rdbms_ddl/pack_ddl.py", "--input", "mysql.json", "--output", "mysql.pack"])
+        ddl_file = "mysql.pack"
+    ddl_stage("generate_mysql_db", ["/generate_rdbms_ddl/generate_mysql_db.py", "--input", ddl_file,
+                                    "--tableoutput", "tables.sql", "--indexoutput", "indexes.sql"])
+    ddl_stage("generate_abl_dump", ["/generate_rdbms_ddl/generate_abl_dump.py", "--input", ddl_file, "--outputdir", workdir + "/abl"])
+    ddl_stage("generate_abl_triggers", ["/generate_rdbms_ddl/generate_abl_triggers.py", "--input", ddl_file, "--outputdir", workdir + "/abl"])
+
+    failed = [s['stage'] for s in report['stages'] if s['exit'] != 0]
+    if len(failed) != 0:
+        print("!!! Not running the persistence engine, since %s failed." % ", ".join(failed))
+    elif parsed_args['target'] != "none":
+        f = open(workdir + "/mysql.json", 'r', encoding="latin_1")
+        ddl = json.loads(f.read())
+        f.close()
+        print("Generating %s JSON files of %s rows." % (parsed_args['files'], parsed_args['rows']))
+        row_count = generate_workload(rng, ddl, workdir + "/json", parsed_args['files'], parsed_args['rows'], parsed_args['recids'],
+                                      parsed_args['skew'], parsed_args['deletes'])
+        engine_args = [TOOLS_DIR + "/persistence_engine/persistence_engine.py", "--input", ddl_file, "--jsondir", workdir + "/json",
+                       "--onepass", "--delay", "0"]
+        if parsed_args['target'] == "sqlite":  # The engine creates the tables itself
+            engine_args += ["--backend", "sqlite", "--sqlitedb", workdir + "/bench.sqlite"]
+        else:
+            f = open(workdir + "/tables.sql", 'r')
+            table_sql = f.read()
+            f.close()
+            print("Creating %s tables in MySQL database '%s'." % (tables, parsed_args['dbname']))
+            prepare_mysql(parsed_args, table_sql)
+        stage = run_stage("persistence_engine", engine_args + shlex.split(parsed_args['engineargs']), workdir, row_count, "rows")
+        stage.update(engine_latency(workdir + "/persistence_engine.log"))
+        report['stages'].append(stage)
+
+    print_report(report)
+
+    if parsed_args['save'] != "":
+        f = open(parsed_args['save'], 'w')
+        f.write(json.dumps(report, indent=2))
+        f.close()
+        print("Wrote report to '%s'." % parsed_args['save'])
+
+    ok = len([s for s in report['stages'] if s['exit'] != 0]) == 0
+    if parsed_args['compare'] != "":
+        f = open(parsed_args['compare'], 'r')
+        baseline = json.loads(f.read())
+        f.close()
+        ok = compare_reports(baseline, report, parsed_args['tolerance']) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.version_info[0] < 3:
+        print("Python 3 or greater is required.")
+        sys.exit(1)
+
+    main()
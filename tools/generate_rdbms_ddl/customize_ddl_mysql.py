@@ -3,6 +3,7 @@ import sys
 import re
 import argparse
 import json
+from pack_ddl import write_ddl_pack
 
 
 def fix_reserved_name(name):
@@ -84,6 +85,8 @@ def main():
     parser.add_argument("--dbport", type=int, default=3306, help="MySQL database port (default: 3306)")
     parser.add_argument("--dbuser", type=str, default="root", help="MySQL database username (default: root)")
     parser.add_argument("--dbpass", type=str, default="", help="MySQL database password (default: null)")
+    parser.add_argument("--pack", action="store_const", const=True, default=False,
+                        help="write output as packed DDL(see pack_ddl.py) instead of JSON (default: false)")
 #    parser.add_argument("--concurrency", metavar='N', type=int, default=1, help="concurrency factor for multiple cpus (default: 1)")
     parsed_args = vars(parser.parse_args())
 
@@ -112,6 +115,10 @@ def main():
     ddl['tables'] = rewrite_tables(ddl['tables'])
     ddl['indexes'] = rewrite_indexes(ddl['indexes'])
 
+    if parsed_args['pack'] is True:
+        if write_ddl_pack(parsed_args['output'], ddl) is True:
+            print("Wrote MySQL customized packed DDL to '%s'." % parsed_args['output'])
+            sys.exit(0)
 
     if write_ddl(parsed_args['output'], json.dumps(ddl)) is True:
         print("Wrote MySQL customized DDL to '%s'." % parsed_args['output'])
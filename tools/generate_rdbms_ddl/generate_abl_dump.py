@@ -3,12 +3,15 @@ import sys
 import re
 import argparse
 import json
+from pack_ddl import is_ddl_pack, read_ddl_pack_header, iter_ddl_pack_tables, iter_ddl_pack_indexes
 
 
-def table_dump_query(table_name, path, rows_per_dump):
+def table_dump_query(table_name, path, rows_per_dump, where="", suffix="", prologue=""):
     """
     Function that accepts table name input string and returns ABL query to create
     temp-table then output json file named t_<table_name>_e_<epoch>.json
+    Partitions pass a where clause, a suffix for the epoch part of filenames, and
+    a prologue that runs before the dump
     """
     return"""
     DEFINE TEMP-TABLE tt NO-UNDO LIKE %(table_name)s
@@ -20,16 +23,16 @@ def table_dump_query(table_name, path, rows_per_dump):
     DEFINE VARIABLE htt AS HANDLE NO-UNDO.
     DEFINE VARIABLE cFileName AS CHARACTER NO-UNDO FORMAT "x(60)".
     DEFINE VARIABLE rowCount as INT64 NO-UNDO.
-
+%(prologue)s
     epoch = DATETIME(1,1,1970,0,0,0,0).
     rowCount = 0.
 
     htt = TEMP-TABLE tt:HANDLE.
 
-    FOR EACH platte.%(table_name)s NO-LOCK:
+    FOR EACH platte.%(table_name)s NO-LOCK%(where)s:
       IF rowCount = %(rows_per_dump)s THEN DO: 
         unixTime = interval(NOW, epoch, "milliseconds").
-        cFileName = "%(path)s/t__%(table_name)s__e__" + STRING(unixTime) + "__insert.json".
+        cFileName = "%(path)s/t__%(table_name)s__e__" + STRING(unixTime) + "%(suffix)s__insert.json".
         htt:WRITE-JSON("FILE", cFileName + "_partial", TRUE).
         OS-RENAME VALUE(cFileName + "_partial") VALUE(cFileName).
         rowCount = 0.
@@ -43,11 +46,111 @@ def table_dump_query(table_name, path, rows_per_dump):
       tt.epoch_time = unixTime.
     END.
     unixTime = interval(NOW, epoch, "milliseconds").
-    cFileName = "%(path)s/t__%(table_name)s__e__" + STRING(unixTime) + "__insert.json".
+    cFileName = "%(path)s/t__%(table_name)s__e__" + STRING(unixTime) + "%(suffix)s__insert.json".
     htt:WRITE-JSON("FILE", cFileName + "_partial", TRUE).
     OS-RENAME VALUE(cFileName + "_partial") VALUE(cFileName)
     
-""" % {'path': path, 'table_name': table_name, 'rows_per_dump': rows_per_dump}
+""" % {'path': path, 'table_name': table_name, 'rows_per_dump': rows_per_dump, 'where': where, 'suffix': suffix, 'prologue': prologue}
+
+
+def partition_key(table, indexes):
+    """
+    Returns (index name, column name) of the first column of table's primary index,
+    or None if the table has no primary index to split on
+    """
+    for index in indexes:
+        if (index['table_name'][0] == table['name'][0]) and (index['index_details'].get('primary') == "PRIMARY"):
+            if len(index['index_details']['columns']) == 0:
+                return None
+            return (index['index_name'][0], index['index_details']['columns'][0][0])
+    return None
+
+
+def partition_plan_query(table_name, index_name, key, partitions, bounds_file):
+    """
+    Returns ABL that walks the primary index of table_name and exports the
+    partitions - 1 values of key that split it into partitions of about equal rows.
+    This counts the rows, then reads up to the last bound, before any dump can start.
+    Only key, the first column of the index, is used, so when it has few distinct
+    values(eg a company code) the bounds repeat and some partitions are empty, which
+    the plan warns about
+    """
+    return"""
+    /* Bound k is the key of row (k * total / %(partitions)s) + 1 in index order.
+       Rows with an unknown key are left to the last partition. */
+    DEFINE VARIABLE total AS INT64 NO-UNDO.
+    DEFINE VARIABLE rowNum AS INT64 NO-UNDO.
+    DEFINE VARIABLE nextBound AS INTEGER NO-UNDO.
+    DEFINE VARIABLE distinctBounds AS INTEGER NO-UNDO.
+    DEFINE VARIABLE lastBound LIKE platte.%(table_name)s.%(key)s NO-UNDO.
+
+    FOR EACH platte.%(table_name)s FIELDS(%(key)s) NO-LOCK WHERE %(table_name)s.%(key)s <> ? USE-INDEX %(index_name)s:
+      total = total + 1.
+    END.
+
+    OUTPUT TO VALUE("%(bounds_file)s_partial").
+    nextBound = 1.
+    FOR EACH platte.%(table_name)s FIELDS(%(key)s) NO-LOCK WHERE %(table_name)s.%(key)s <> ? USE-INDEX %(index_name)s:
+      rowNum = rowNum + 1.
+      DO WHILE nextBound < %(partitions)s AND rowNum = TRUNCATE(nextBound * total / %(partitions)s, 0) + 1:
+        EXPORT %(table_name)s.%(key)s.
+        IF distinctBounds = 0 OR %(table_name)s.%(key)s <> lastBound THEN
+          distinctBounds = distinctBounds + 1.
+        lastBound = %(table_name)s.%(key)s.
+        nextBound = nextBound + 1.
+      END.
+      IF nextBound = %(partitions)s THEN LEAVE.
+    END.
+    OUTPUT CLOSE.
+    OS-RENAME VALUE("%(bounds_file)s_partial") VALUE("%(bounds_file)s").
+    MESSAGE "Planned %(partitions)s partitions of " + STRING(total) + " rows in %(table_name)s".
+    IF total > 0 AND distinctBounds < %(partitions)s - 1 THEN
+      MESSAGE "!!! WARNING: only " + STRING(distinctBounds) + " distinct bounds on %(table_name)s.%(key)s,"
+              "too few values to split %(table_name)s into %(partitions)s partitions, some will be empty".
+
+""" % {'table_name': table_name, 'index_name': index_name, 'key': key, 'partitions': partitions, 'bounds_file': bounds_file}
+
+
+def partition_dump_query(table_name, path, rows_per_dump, index_name, key, partitions, partition, bounds_file):
+    """
+    Returns ABL that dumps one partition of table_name, the rows whose key falls
+    between the bounds written by partition_plan_query, to JSON files whose epoch
+    part ends in _<partition>. With no bounds, when no row had a known key at plan
+    time, the last partition dumps the whole table and the others nothing
+    """
+    unplanned = ""
+    if partition != partitions - 1:
+        unplanned = """    IF boundCount <> %(partitions)s - 1 THEN DO:
+      MESSAGE "%(table_name)s had no known keys when planned, partition %(last)s dumps it whole".
+      RETURN.
+    END.
+""" % {'table_name': table_name, 'partitions': partitions, 'last': partitions - 1}
+    prologue = """
+    DEFINE VARIABLE lo LIKE platte.%(table_name)s.%(key)s NO-UNDO.
+    DEFINE VARIABLE hi LIKE platte.%(table_name)s.%(key)s NO-UNDO.
+    DEFINE VARIABLE bound LIKE platte.%(table_name)s.%(key)s NO-UNDO.
+    DEFINE VARIABLE boundCount AS INTEGER NO-UNDO.
+
+    /* Partition %(partition)s covers bound %(partition)s up to bound %(next)s, bounds 0 and %(partitions)s being open */
+    INPUT FROM VALUE("%(bounds_file)s").
+    REPEAT ON ENDKEY UNDO, LEAVE:
+      IMPORT bound.
+      boundCount = boundCount + 1.
+      IF boundCount = %(partition)s THEN lo = bound.
+      IF boundCount = %(next)s THEN hi = bound.
+    END.
+    INPUT CLOSE.
+%(unplanned)s""" % {'table_name': table_name, 'key': key, 'partitions': partitions, 'partition': partition, 'next': partition + 1,
+                    'bounds_file': bounds_file, 'unplanned': unplanned}
+    column = "%s.%s" % (table_name, key)
+    if partition == 0:
+        where = " WHERE %s < hi" % column
+    elif partition == partitions - 1:
+        where = " WHERE boundCount <> %s - 1 OR %s >= lo OR %s = ?" % (partitions, column, column)
+    else:
+        where = " WHERE %s >= lo AND %s < hi" % (column, column)
+    where += " USE-INDEX %s" % index_name
+    return table_dump_query(table_name, path, rows_per_dump, where=where, suffix="_%s" % partition, prologue=prologue)
 
 
 def read_ddl(filename):
@@ -80,20 +183,61 @@ def main():
     parser_required.add_argument("--outputdir", type=str, required=True, help="output directory for ABL files")
     parser.add_argument("--jsondir", type=str, default="/tmp", help="directory to output JSON table dumps (default: /tmp)")
     parser.add_argument("--rows", type=int, default=250000, help="rows per JSON file (default: 250000)")
+    parser.add_argument("--partitions", metavar='N', type=int, default=1,
+                        help="split each table into N dumps by ranges of the first column of its primary index, to be run concurrently after the "
+                             "table's plan program (default: 1)")
     parsed_args = vars(parser.parse_args())
 
-    ddl = read_ddl(parsed_args['input'])
-
-    try:
-        print("Parsing %s" % parsed_args['input'])
-        ddl = json.loads(read_ddl(parsed_args['input']), encoding="latin_1")
-    except ValueError as e:
-        print("Failed to load %s, error: %s" % (parsed_args['input'], e))
-        sys.exit(1)
-
+    if is_ddl_pack(parsed_args['input']) and (parsed_args['partitions'] > 1):
+        # Partitions need each table's primary index, so every section is read
+        print("Reading packed DDL %s" % parsed_args['input'])
+        header = read_ddl_pack_header(parsed_args['input'])
+        ddl = {"tables": list(iter_ddl_pack_tables(parsed_args['input'], header)),
+               "indexes": list(iter_ddl_pack_indexes(parsed_args['input'], header))}
+    elif is_ddl_pack(parsed_args['input']):
+        # Only table names are needed, and packed DDL carries those in its header
+        print("Reading packed DDL header %s" % parsed_args['input'])
+        header = read_ddl_pack_header(parsed_args['input'])
+        ddl = {"tables": [{"name": [t[0]]} for t in header['tables']]}
+    else:
+        ddl = read_ddl(parsed_args['input'])
+
+        try:
+            print("Parsing %s" % parsed_args['input'])
+            ddl = json.loads(read_ddl(parsed_args['input']), encoding="latin_1")
+        except ValueError as e:
+            print("Failed to load %s, error: %s" % (parsed_args['input'], e))
+            sys.exit(1)
+
+    manifest = {"partitions": parsed_args['partitions'], "jsondir": parsed_args['jsondir'], "tables": []}
     for table in ddl['tables']:
-        filename = "%s/abl_dump_%s.p" % (parsed_args['outputdir'], table['name'][0])
-        write_abl(filename, table_dump_query(table['name'][0], parsed_args['jsondir'], parsed_args['rows']))
+        key = None
+        if parsed_args['partitions'] > 1:
+            key = partition_key(table, ddl.get('indexes', []))
+            if key is None:
+                print("Table '%s' has no primary index to partition on, it will be dumped whole." % table['name'][0])
+        if key is None:
+            filename = "%s/abl_dump_%s.p" % (parsed_args['outputdir'], table['name'][0])
+            write_abl(filename, table_dump_query(table['name'][0], parsed_args['jsondir'], parsed_args['rows']))
+            manifest['tables'].append({"table": table['name'][0], "plan": None, "dumps": [filename]})
+            continue
+
+        index_name, column = key
+        bounds_file = "%s/abl_dump_%s.bounds" % (parsed_args['outputdir'], table['name'][0])
+        plan = "%s/abl_dump_%s_plan.p" % (parsed_args['outputdir'], table['name'][0])
+        write_abl(plan, partition_plan_query(table['name'][0], index_name, column, parsed_args['partitions'], bounds_file))
+        dumps = []
+        for partition in range(parsed_args['partitions']):
+            filename = "%s/abl_dump_%s_%s.p" % (parsed_args['outputdir'], table['name'][0], partition)
+            write_abl(filename, partition_dump_query(table['name'][0], parsed_args['jsondir'], parsed_args['rows'], index_name, column,
+                                                     parsed_args['partitions'], partition, bounds_file))
+            dumps.append(filename)
+        manifest['tables'].append({"table": table['name'][0], "index": index_name, "column": column, "plan": plan,
+                                   "bounds": bounds_file, "dumps": dumps})
+
+    if parsed_args['partitions'] > 1:
+        # Run each table's plan, then its dumps in any order or all at once
+        write_abl("%s/abl_dump_manifest.json" % parsed_args['outputdir'], json.dumps(manifest, indent=2))
 
 
 if __name__ == "__main__":
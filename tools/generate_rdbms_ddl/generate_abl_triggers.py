@@ -3,6 +3,8 @@ import sys
 import re
 import argparse
 import json
+import zlib
+from pack_ddl import is_ddl_pack, read_ddl_pack_header
 
 
 def add_trigger_query(table, triggerdir):
@@ -123,6 +125,219 @@ OS-RENAME VALUE(cFileName + "_partial") VALUE(cFileName).
 """ % {"table": table, "jsondir": jsondir}
 
 
+# Per-table batch state, shared by the batched triggers and flush procedures of every table in a session
+BATCH_STATE_DEFINITION = """
+DEFINE NEW GLOBAL SHARED TEMP-TABLE tt_repl_batch NO-UNDO
+    FIELD table_name AS CHARACTER
+    FIELD write_rows AS INTEGER
+    FIELD delete_rows AS INTEGER
+    FIELD task_id AS INTEGER
+    FIELD started AS INT64
+    FIELD last_flush AS INT64
+    INDEX table_name IS PRIMARY UNIQUE table_name.
+"""
+
+
+def abl_buffer_name(prefix, table):
+    """Returns the name of a GLOBAL SHARED temp-table buffering changes to table. ABL names are limited to 32 characters, so long
+    table names are shortened and made unique with a CRC of the full name.
+    """
+    name = prefix + table
+    if len(name) > 32:
+        name = "%s%s_%08x" % (prefix, table[:32 - len(prefix) - 9], zlib.crc32(table.encode()))
+    return name
+
+
+def batch_definitions(table):
+    """Returns the GLOBAL SHARED temp-tables used by a table's batched triggers and flush procedure. Every procedure sharing them
+    must define them identically. SERIALIZE-NAME keeps the "tt" key the persistence engine reads rows from.
+    """
+    return BATCH_STATE_DEFINITION + """
+DEFINE NEW GLOBAL SHARED TEMP-TABLE %(ttw)s NO-UNDO SERIALIZE-NAME "tt" LIKE %(table)s
+    FIELD rec_id AS RECID
+    FIELD epoch_time AS INT64
+    INDEX rec_id IS PRIMARY UNIQUE rec_id.
+
+DEFINE NEW GLOBAL SHARED TEMP-TABLE %(ttd)s NO-UNDO SERIALIZE-NAME "tt"
+    FIELD rec_id AS RECID
+    FIELD epoch_time AS INT64.
+""" % {"table": table, "ttw": abl_buffer_name("ttw_", table), "ttd": abl_buffer_name("ttd_", table)}
+
+
+def batch_flush_condition(batchrows, batchms, rows_field):
+    """Returns the ABL condition for flushing a table's buffer after an event has been added to it.
+    """
+    condition = "tt_repl_batch.%s >= %s" % (rows_field, batchrows)
+    if batchms > 0:
+        condition += " OR unixTime - tt_repl_batch.started >= %s" % batchms
+    return condition
+
+
+def batch_state_query(table):
+    return """
+FIND tt_repl_batch WHERE tt_repl_batch.table_name = '%(table)s' NO-ERROR.
+IF NOT AVAILABLE tt_repl_batch THEN DO:
+    CREATE tt_repl_batch.
+    tt_repl_batch.table_name = '%(table)s'.
+END.
+""" % {"table": table}
+
+
+def batch_flush_call(table, triggerdir, buffers):
+    """Returns an ABL block running the flush procedure of table. The flush procedure reads and resets the shared records through its
+    own buffers, so the trigger's buffers are released first to write its changes, and the batch state is found again afterwards.
+    """
+    return """DO:
+    RELEASE %(buffers)s.
+    RUN VALUE("%(flushproc)s").
+    FIND tt_repl_batch WHERE tt_repl_batch.table_name = '%(table)s'.
+END.""" % {"table": table, "flushproc": "%s/abl_trigger_%s_flush.p" % (triggerdir, table), "buffers": ".\n    RELEASE ".join(buffers)}
+
+
+def batch_flush_due_query(table, triggerdir, batchms, batchscope):
+    """Returns ABL flushing the buffers of other tables in the session that are due, those of an earlier transaction with
+    --batchscope transaction, or --batchms old, so a change to a quiet table does not wait for that table to change again.
+    """
+    due = []
+    if batchscope == "transaction":
+        due.append("tt_repl_batch.task_id <> taskId")
+    if batchms > 0:
+        due.append("unixTime - tt_repl_batch.started >= %s" % batchms)
+    if len(due) == 0:
+        return ""
+    return """
+FOR EACH tt_repl_batch WHERE tt_repl_batch.table_name <> '%(table)s'
+        AND (tt_repl_batch.write_rows > 0 OR tt_repl_batch.delete_rows > 0) AND (%(due)s):
+    RUN VALUE("%(triggerdir)s/abl_trigger_" + tt_repl_batch.table_name + "_flush.p").
+END.
+""" % {"table": table, "triggerdir": triggerdir, "due": " OR ".join(due)}
+
+
+def trigger_rw_batch_query(table, triggerdir, batchrows, batchms, batchscope):
+    return """
+TRIGGER PROCEDURE FOR WRITE OF %(table)s.
+%(definitions)s
+DEFINE VARIABLE epoch AS DATETIME NO-UNDO.
+DEFINE VARIABLE unixTime AS INT64 NO-UNDO.
+DEFINE VARIABLE taskId AS INTEGER NO-UNDO.
+
+epoch = DATETIME(1,1,1970,0,0,0,0).
+unixTime = interval(NOW, epoch, "milliseconds").
+taskId = %(task_id)s.
+%(due)s%(state)s
+/* Files must stay in event order, so buffered deletes, and writes from an earlier transaction, are written first */
+IF tt_repl_batch.delete_rows > 0 OR (tt_repl_batch.write_rows > 0 AND tt_repl_batch.task_id <> taskId) THEN %(flush_state)s
+IF tt_repl_batch.write_rows = 0 THEN
+    ASSIGN tt_repl_batch.started = unixTime
+           tt_repl_batch.task_id = taskId.
+
+/* A record written again before the flush only needs its newest image */
+FIND %(ttw)s WHERE %(ttw)s.rec_id = RECID(%(table)s) NO-ERROR.
+IF NOT AVAILABLE %(ttw)s THEN DO:
+    CREATE %(ttw)s.
+    tt_repl_batch.write_rows = tt_repl_batch.write_rows + 1.
+END.
+BUFFER-COPY %(table)s TO %(ttw)s.
+%(ttw)s.rec_id = RECID(%(table)s).
+%(ttw)s.epoch_time = unixTime.
+
+IF %(condition)s THEN %(flush_rows)s
+""" % {"table": table, "definitions": batch_definitions(table), "state": batch_state_query(table),
+       "ttw": abl_buffer_name("ttw_", table),
+       "flush_state": batch_flush_call(table, triggerdir, ["tt_repl_batch"]),
+       "flush_rows": batch_flush_call(table, triggerdir, ["tt_repl_batch", abl_buffer_name("ttw_", table)]),
+       "task_id": "DBTASKID(LDBNAME(BUFFER %s))" % table if batchscope == "transaction" else "0",
+       "due": batch_flush_due_query(table, triggerdir, batchms, batchscope),
+       "condition": batch_flush_condition(batchrows, batchms, "write_rows")}
+
+
+def trigger_rd_batch_query(table, triggerdir, batchrows, batchms, batchscope):
+    return """
+TRIGGER PROCEDURE FOR DELETE OF %(table)s.
+%(definitions)s
+DEFINE VARIABLE epoch AS DATETIME NO-UNDO.
+DEFINE VARIABLE unixTime AS INT64 NO-UNDO.
+DEFINE VARIABLE taskId AS INTEGER NO-UNDO.
+
+epoch = DATETIME(1,1,1970,0,0,0,0).
+unixTime = interval(NOW, epoch, "milliseconds").
+taskId = %(task_id)s.
+%(due)s%(state)s
+/* Files must stay in event order, so buffered writes, and deletes from an earlier transaction, are written first */
+IF tt_repl_batch.write_rows > 0 OR (tt_repl_batch.delete_rows > 0 AND tt_repl_batch.task_id <> taskId) THEN %(flush_state)s
+IF tt_repl_batch.delete_rows = 0 THEN
+    ASSIGN tt_repl_batch.started = unixTime
+           tt_repl_batch.task_id = taskId.
+
+CREATE %(ttd)s.
+ASSIGN %(ttd)s.rec_id = RECID(%(table)s).
+ASSIGN %(ttd)s.epoch_time = unixTime.
+tt_repl_batch.delete_rows = tt_repl_batch.delete_rows + 1.
+
+IF %(condition)s THEN %(flush_rows)s
+""" % {"table": table, "definitions": batch_definitions(table), "state": batch_state_query(table),
+       "ttd": abl_buffer_name("ttd_", table),
+       "flush_state": batch_flush_call(table, triggerdir, ["tt_repl_batch"]),
+       "flush_rows": batch_flush_call(table, triggerdir, ["tt_repl_batch", abl_buffer_name("ttd_", table)]),
+       "task_id": "DBTASKID(LDBNAME(BUFFER %s))" % table if batchscope == "transaction" else "0",
+       "due": batch_flush_due_query(table, triggerdir, batchms, batchscope),
+       "condition": batch_flush_condition(batchrows, batchms, "delete_rows")}
+
+
+def trigger_flush_query(table, jsondir):
+    return """
+/* Writes the changes buffered by the batched triggers of %(table)s, one file per operation. Files are named for the oldest change
+   they hold rather than the time of the flush, so they sort among other sessions' files by when their changes were made. */
+%(definitions)s
+DEFINE VARIABLE unixTime AS INT64 NO-UNDO.
+DEFINE VARIABLE htt AS HANDLE NO-UNDO.
+DEFINE VARIABLE cFileName AS CHARACTER NO-UNDO FORMAT "x(60)".
+
+FIND tt_repl_batch WHERE tt_repl_batch.table_name = '%(table)s' NO-ERROR.
+IF NOT AVAILABLE tt_repl_batch THEN
+    RETURN.
+
+unixTime = tt_repl_batch.started.
+
+IF tt_repl_batch.write_rows > 0 THEN DO:
+    /* Two flushes starting in the same millisecond must not share a filename */
+    IF unixTime <= tt_repl_batch.last_flush THEN
+        unixTime = tt_repl_batch.last_flush + 1.
+    cFileName = "%(jsondir)s/t__%(table)s__e__" + STRING(unixTime) + "__write.json".
+    htt = TEMP-TABLE %(ttw)s:HANDLE.
+    htt:WRITE-JSON("FILE", cFileName + "_partial", TRUE).
+    OS-RENAME VALUE(cFileName + "_partial") VALUE(cFileName).
+    EMPTY TEMP-TABLE %(ttw)s.
+    tt_repl_batch.write_rows = 0.
+    tt_repl_batch.last_flush = unixTime.
+END.
+
+IF tt_repl_batch.delete_rows > 0 THEN DO:
+    IF unixTime <= tt_repl_batch.last_flush THEN
+        unixTime = tt_repl_batch.last_flush + 1.
+    cFileName = "%(jsondir)s/t__%(table)s__e__" + STRING(unixTime) + "__delete.json".
+    htt = TEMP-TABLE %(ttd)s:HANDLE.
+    htt:WRITE-JSON("FILE", cFileName + "_partial", TRUE).
+    OS-RENAME VALUE(cFileName + "_partial") VALUE(cFileName).
+    EMPTY TEMP-TABLE %(ttd)s.
+    tt_repl_batch.delete_rows = 0.
+    tt_repl_batch.last_flush = unixTime.
+END.
+""" % {"table": table, "jsondir": jsondir, "definitions": batch_definitions(table),
+       "ttw": abl_buffer_name("ttw_", table), "ttd": abl_buffer_name("ttd_", table)}
+
+
+def flush_all_query(triggerdir):
+    return """
+/* Writes every change still buffered by batched triggers in this session. Run this before the session ends, or buffered changes
+   are lost, and after transactions whose changes must not wait for the next change to the same table. */
+%(definitions)s
+FOR EACH tt_repl_batch WHERE tt_repl_batch.write_rows > 0 OR tt_repl_batch.delete_rows > 0:
+    RUN VALUE("%(triggerdir)s/abl_trigger_" + tt_repl_batch.table_name + "_flush.p").
+END.
+""" % {"triggerdir": triggerdir, "definitions": BATCH_STATE_DEFINITION}
+
+
 def read_ddl(filename):
     try:
         f = open(filename, 'r', encoding="latin_1")
@@ -152,27 +367,61 @@ def main():
     parser_required.add_argument("--input", type=str, required=True, help="input file containing RDBMS-customized intermediate DDL")
     parser_required.add_argument("--outputdir", type=str, required=True, help="output directory for ABL files - YOU MUST USE a fully qualified path (GOOD: /home/user1/dir1, BAD: ~/home/user1/dir1)")
     parser.add_argument("--jsondir", type=str, default="/tmp", help="directory to output JSON table changes (default: /tmp)")
+    parser.add_argument("--batchrows", metavar='N', type=int, default=0,
+                        help="buffer changes in the session and write one file per N rows of a table, 0 writes one file per change (default: 0)")
+    parser.add_argument("--batchms", metavar='MS', type=int, default=0,
+                        help="with --batchrows, also write a table's buffered changes once the oldest is MS milliseconds old, checked on each "
+                             "change, 0 disables (default: 0)")
+    parser.add_argument("--batchscope", type=str, choices=('transaction', 'session'), default="transaction",
+                        help="with --batchrows, 'transaction' never puts changes from different transactions in one file, "
+                             "'session' does (default: transaction)")
     parsed_args = vars(parser.parse_args())
 
-    ddl = read_ddl(parsed_args['input'])
-
-    try:
-        print("Parsing %s" % parsed_args['input'])
-        ddl = json.loads(read_ddl(parsed_args['input']))
-    except ValueError as e:
-        print("Failed to load %s, error: %s" % (parsed_args['input'], e))
-        sys.exit(1)
+    if is_ddl_pack(parsed_args['input']):
+        # Only table names are needed, and packed DDL carries those in its header
+        print("Reading packed DDL header %s" % parsed_args['input'])
+        header = read_ddl_pack_header(parsed_args['input'])
+        ddl = {"tables": [{"name": [t[0]]} for t in header['tables']]}
+    else:
+        ddl = read_ddl(parsed_args['input'])
+
+        try:
+            print("Parsing %s" % parsed_args['input'])
+            ddl = json.loads(read_ddl(parsed_args['input']))
+        except ValueError as e:
+            print("Failed to load %s, error: %s" % (parsed_args['input'], e))
+            sys.exit(1)
 
     for table in ddl['tables']:
         filename = "%s/abl_add_trigger_%s.p" % (parsed_args['outputdir'], table['name'][0])
         write_abl(filename, add_trigger_query(table['name'][0], parsed_args['outputdir']))
 
+        if parsed_args['batchrows'] > 0:
+            batch_args = (parsed_args['outputdir'], parsed_args['batchrows'], parsed_args['batchms'], parsed_args['batchscope'])
+            filename = "%s/abl_trigger_%s_rw.t" % (parsed_args['outputdir'], table['name'][0])
+            write_abl(filename, trigger_rw_batch_query(table['name'][0], *batch_args))
+
+            filename = "%s/abl_trigger_%s_rd.t" % (parsed_args['outputdir'], table['name'][0])
+            write_abl(filename, trigger_rd_batch_query(table['name'][0], *batch_args))
+
+            filename = "%s/abl_trigger_%s_flush.p" % (parsed_args['outputdir'], table['name'][0])
+            write_abl(filename, trigger_flush_query(table['name'][0], parsed_args['jsondir']))
+            continue
+
         filename = "%s/abl_trigger_%s_rw.t" % (parsed_args['outputdir'], table['name'][0])
         write_abl(filename, trigger_rw_query(table['name'][0], parsed_args['jsondir']))
 
         filename = "%s/abl_trigger_%s_rd.t" % (parsed_args['outputdir'], table['name'][0])
         write_abl(filename, trigger_rd_query(table['name'][0], parsed_args['jsondir']))
 
+    if parsed_args['batchrows'] > 0:
+        write_abl("%s/abl_flush_triggers.p" % parsed_args['outputdir'], flush_all_query(parsed_args['outputdir']))
+        print("")
+        print("!!! WARNING: --batchrows triggers hold changes in the memory of the session that made them. A change is only")
+        print("!!! written when its batch fills, at the session's next change to a replicated table once due, or when the")
+        print("!!! session runs '%s/abl_flush_triggers.p'. Changes still held when a session exits are LOST," % parsed_args['outputdir'])
+        print("!!! so every session changing replicated tables must run it before exiting, and after changes that must not wait.")
+
 if __name__ == "__main__":
     import sys 
     if sys.version_info[0] < 3:
@@ -3,6 +3,7 @@ import sys
 import re
 import argparse
 import json
+from pack_ddl import is_ddl_pack, read_ddl_pack_header, iter_ddl_pack_tables, iter_ddl_pack_indexes
 import pdb
 
 
@@ -96,14 +97,21 @@ def main():
     parser_required.add_argument("--indexoutput", type=str, required=True, help="output file for SQL index DDL")
     parsed_args = vars(parser.parse_args())
 
-    ddl = read_ddl(parsed_args['input'])
-
-    try:
-        print("Parsing %s" % parsed_args['input'])
-        ddl = json.loads(read_ddl(parsed_args['input']), encoding="latin_1")
-    except ValueError as e:
-        print("Failed to load %s, error: %s" % (parsed_args['input'], e))
-        sys.exit(1)
+    if is_ddl_pack(parsed_args['input']):
+        # Packed DDL is decoded one table at a time as the SQL is built, rather than all up front
+        print("Reading packed DDL %s" % parsed_args['input'])
+        header = read_ddl_pack_header(parsed_args['input'])
+        ddl = {"tables": iter_ddl_pack_tables(parsed_args['input'], header),
+               "indexes": iter_ddl_pack_indexes(parsed_args['input'], header)}
+    else:
+        ddl = read_ddl(parsed_args['input'])
+
+        try:
+            print("Parsing %s" % parsed_args['input'])
+            ddl = json.loads(read_ddl(parsed_args['input']), encoding="latin_1")
+        except ValueError as e:
+            print("Failed to load %s, error: %s" % (parsed_args['input'], e))
+            sys.exit(1)
 
     print("Building table creation SQL.")
     create_table_sql = gen_table_create(ddl['tables'])
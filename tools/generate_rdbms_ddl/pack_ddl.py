@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import json
+import mmap
+
+
+PACK_MAGIC = b"PROREPTK-DDLPACK 1\n"
+
+
+def is_ddl_pack(filename):
+    """Returns True if filename is a packed DDL file written by write_ddl_pack, rather than a JSON DDL file.
+    """
+    try:
+        f = open(filename, 'rb')
+        magic = f.read(len(PACK_MAGIC))
+        f.close()
+        return magic == PACK_MAGIC
+    except IOError as e:
+        print("Could not read file '%s'!" % filename)
+        sys.exit(1)
+
+
+def write_ddl_pack(filename, ddl):
+    """Writes ddl as a packed DDL file. The file holds PACK_MAGIC, then a single line of JSON header, then one JSON section per table
+    and one per table's list of indexes. The header holds every top-level key of ddl other than 'tables' and 'indexes'(such as
+    'config'), and the [name, offset, length] of each section, with offsets counted from the end of the header line.
+    """
+    sections = []
+    header = {"ddl": {}, "tables": [], "indexes": []}
+    for key in ddl:
+        if (key != "tables") and (key != "indexes"):
+            header['ddl'][key] = ddl[key]
+
+    offset = 0
+    for table in ddl.get('tables', []):
+        section = json.dumps(table).encode("ascii")
+        header['tables'].append([table['name'][0], offset, len(section)])
+        sections.append(section)
+        offset += len(section)
+
+    indexes_by_table = {}
+    for index in ddl.get('indexes', []):
+        table_name = index['table_name'][0]
+        if table_name not in indexes_by_table:
+            indexes_by_table[table_name] = []
+            header['indexes'].append([table_name, None, None])
+        indexes_by_table[table_name].append(index)
+    for entry in header['indexes']:
+        section = json.dumps(indexes_by_table[entry[0]]).encode("ascii")
+        entry[1] = offset
+        entry[2] = len(section)
+        sections.append(section)
+        offset += len(section)
+
+    try:
+        f = open(filename, 'wb')
+        f.write(PACK_MAGIC)
+        f.write(json.dumps(header).encode("ascii") + b"\n")
+        for section in sections:
+            f.write(section)
+        f.close()
+        return True
+    except IOError as e:
+        print("Could not write file '%s'!" % filename)
+        sys.exit(1)
+
+
+def read_ddl_pack_header(filename):
+    """Returns the header of a packed DDL file, with 'data_start' set to the file offset that section offsets are counted from.
+    """
+    try:
+        f = open(filename, 'rb')
+        f.readline()  # PACK_MAGIC
+        header = json.loads(f.readline().decode("ascii"))
+        header['data_start'] = f.tell()
+        f.close()
+        return header
+    except (IOError, ValueError) as e:
+        print("Could not read packed DDL header from '%s'! Error: %s" % (filename, e))
+        sys.exit(1)
+
+
+def read_ddl_pack_section(filename, header, offset, length):
+    """Memory-maps filename and decodes the single section at offset, leaving the rest of the file unread.
+    """
+    f = open(filename, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = header['data_start'] + offset
+        return json.loads(mm[start:start+length].decode("ascii"))
+    finally:
+        mm.close()
+        f.close()
+
+
+def iter_ddl_pack_tables(filename, header, table_names=None):
+    """Yields the tables of a packed DDL file one at a time, optionally only those named in table_names.
+    """
+    for table_name, offset, length in header['tables']:
+        if (table_names is None) or (table_name in table_names):
+            yield read_ddl_pack_section(filename, header, offset, length)
+
+
+def iter_ddl_pack_indexes(filename, header, table_names=None):
+    """Yields the indexes of a packed DDL file one at a time, optionally only those on tables named in table_names.
+    """
+    for table_name, offset, length in header['indexes']:
+        if (table_names is None) or (table_name in table_names):
+            for index in read_ddl_pack_section(filename, header, offset, length):
+                yield index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert JSON DDL to or from the packed DDL format")
+    parser_required = parser.add_argument_group("required arguments")
+    parser_required.add_argument("--input", type=str, required=True, help="input file containing JSON DDL, or packed DDL with --unpack")
+    parser_required.add_argument("--output", type=str, required=True, help="output file for packed DDL, or JSON DDL with --unpack")
+    parser.add_argument("--unpack", action="store_const", const=True, default=False, help="convert packed DDL back to JSON DDL (default: false)")
+    parsed_args = vars(parser.parse_args())
+
+    if parsed_args['unpack'] is True:
+        header = read_ddl_pack_header(parsed_args['input'])
+        ddl = header['ddl']
+        ddl['tables'] = list(iter_ddl_pack_tables(parsed_args['input'], header))
+        ddl['indexes'] = list(iter_ddl_pack_indexes(parsed_args['input'], header))
+        try:
+            f = open(parsed_args['output'], 'w', encoding="latin_1")
+            f.write(json.dumps(ddl))
+            f.close()
+        except IOError as e:
+            print("Could not write file '%s'!" % parsed_args['output'])
+            sys.exit(1)
+        print("Wrote JSON DDL to '%s'." % parsed_args['output'])
+        sys.exit(0)
+
+    try:
+        f = open(parsed_args['input'], 'r', encoding="latin_1")
+        ddl = json.loads(f.read())
+        f.close()
+    except (IOError, ValueError) as e:
+        print("Failed to load %s, error: %s" % (parsed_args['input'], e))
+        sys.exit(1)
+
+    if write_ddl_pack(parsed_args['output'], ddl) is True:
+        print("Wrote packed DDL with %s tables to '%s'." % (len(ddl.get('tables', [])), parsed_args['output']))
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.version_info[0] < 3:
+        print("Python 3 or greater is required.")
+        sys.exit(1)
+
+    main()
@@ -31,7 +31,9 @@ ABLPATH="/mnt/jsondump/4gl"
 JSONPATH="/mnt/jsondump/json"
 ABLRUNNER=".../proreptk/tools/progress_scripts/run_4gl_silent" # TODO
 DDL="" # TODO
-PERUNNER="/usr/local/bin/python3.4 -u /root/src/proreptk/tools/persistence_engine/persistence_engine.py --input ${DDL} --concurrency files --processes 6 --onepass --globpattern t__${TABLE}__e*.json --jsondir ${JSONPATH} --delay 1 --fastinsert" # TODO
+BULKLOAD="" # set to "--bulkload" to load the dump with LOAD DATA LOCAL INFILE, the MySQL server must allow local_infile
+PYTHON="/usr/local/bin/python3.4" # TODO
+PERUNNER="${PYTHON} -u /root/src/proreptk/tools/persistence_engine/persistence_engine.py --input ${DDL} --concurrency files --processes 6 --onepass --globpattern t__${TABLE}__e*.json --jsondir ${JSONPATH} --delay 1 --fastinsert ${BULKLOAD}" # TODO
 
 ##################
 ## SQL definitions
@@ -60,7 +62,22 @@ function place_lock {
 function dump_jsons {
     update_now
     echo "${NOW}: dumping JSONs for ${TABLE}"
-    ${ABLRUNNER} ${ABLPATH}/abl_dump_${TABLE}.p
+    # generate_abl_dump.py --partitions lists each table's plan program, then its dump programs, in abl_dump_manifest.json
+    PROGRAMS=$(${PYTHON} -c 'import json, sys
+for t in json.load(open(sys.argv[1]))["tables"]:
+    if (t["table"] == sys.argv[2]) and (t["plan"] is not None):
+        print(" ".join([t["plan"]] + t["dumps"]))' ${ABLPATH}/abl_dump_manifest.json ${TABLE} 2>/dev/null)
+    if [ -n "${PROGRAMS}" ]; then
+        set -- ${PROGRAMS}
+        ${ABLRUNNER} $1
+        shift
+        for PARTITION in "$@"; do
+            ${ABLRUNNER} ${PARTITION} &
+        done
+        wait
+    else
+        ${ABLRUNNER} ${ABLPATH}/abl_dump_${TABLE}.p
+    fi
 }
 
 function persist_rows {
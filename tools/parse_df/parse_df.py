@@ -2,8 +2,8 @@ import pdb
 import sys
 import re
 import argparse
-from multiprocessing import Pool
 import json
+import hashlib
 
 
 def read_df(filename):
@@ -28,33 +28,161 @@ def write_ddl(filename, ddl):
         sys.exit(1)
 
 
-def parse_index_names(df):
-    df = re.sub('\n', '_EOL_', df)
-    indexes = re.findall(r'ADD INDEX "(.+?)" ON "(.*?)"', df)
-    return indexes
-
-
-def parse_index_fields(iteration, total_indexes, index_name, table_name, df):
-    print("(%s/%s) Parsing index '%s' on table '%s'" % (iteration, total_indexes, index_name, table_name))
+def statement_lines(lines, start, stop):
+    """Returns lines[start:stop] up to, but not including, the first empty line.
+    """
+    block = []
+    for line in lines[start:stop]:
+        if len(line) == 0:
+            break
+        block.append(line)
+    return block
+
+
+def block_hash(lines):
+    return hashlib.sha1('\n'.join(lines).encode("latin_1")).hexdigest()
+
+
+def scan_df(df, cached_blocks={}):
+    """Scans the lines of df a single time, returning a dictionary of:
+      tables: table names in the order they are added
+      fields: {table name: [column metadata, ...]}
+      indexes: (index name, table name) tuples in the order they are added
+      index_details: {(index name, table name): index metadata}
+      blocks: {hash: column or index metadata} for every ADD FIELD and ADD INDEX statement
+      table_hashes: {table name: hash of its ADD TABLE statement}
+      field_hashes: {table name: [hash of each ADD FIELD statement]}
+      index_hashes: {(index name, table name): hash of its ADD INDEX statement}
+      reused: number of statements found in cached_blocks(a `blocks` dictionary from an earlier scan) instead of being parsed
+    """
     lines = df.split('\n')
-    pat = r'^ADD INDEX "%s" ON "%s" $' % (index_name, table_name)
-    index_details = None
+    scanned = {"tables": [], "fields": {}, "indexes": [], "index_details": {},
+               "blocks": {}, "table_hashes": {}, "field_hashes": {}, "index_hashes": {}, "reused": 0}
     for i in range(0, len(lines)):
-        m = re.search(pat, lines[i])
-        if m is None:
+        line = lines[i]
+        if line.startswith('ADD ') is False:
             continue
-        else:
+
+        m = re.match(r'ADD TABLE "(.+?)"', line)
+        if m is not None:
+            scanned['tables'].append(m.groups()[0])
+            scanned['table_hashes'][m.groups()[0]] = block_hash([line] + statement_lines(lines, i+1, len(lines)))
+            continue
+
+        m = re.match(r'ADD FIELD "(.+?)" OF "(.+?)" AS (.+?) $', line)
+        if m is not None:
+            col_name, table_name, col_type = m.groups()
+            block = statement_lines(lines, i+1, i+20)
+            h = block_hash([line] + block)
+            if h in cached_blocks:
+                scanned['reused'] += 1
+                scanned['blocks'][h] = cached_blocks[h]
+            else:
+                scanned['blocks'][h] = parse_table_col_metadata(col_name, col_type, block)
+            if table_name not in scanned['fields']:
+                scanned['fields'][table_name] = []
+                scanned['field_hashes'][table_name] = []
+            scanned['fields'][table_name].append(scanned['blocks'][h])
+            scanned['field_hashes'][table_name].append(h)
+            continue
+
+        m = re.match(r'ADD INDEX "(.+?)" ON "(.*?)"', line)
+        if m is not None:
+            scanned['indexes'].append(m.groups())
             offset = i + 250  # maximum limit of descriptive lines for an index
             if offset > len(lines)-1:
                 offset = len(lines) - 1
-            index_details = parse_index_metadata(index_name, lines[i+1:offset])
-    return {"index_name": index_name, "table_name": table_name, "index_details": index_details}
+            block = statement_lines(lines, i+1, offset)
+            h = block_hash([line] + block)
+            scanned['index_hashes'][m.groups()] = h
+            if line == 'ADD INDEX "%s" ON "%s" ' % m.groups():
+                if h in cached_blocks:
+                    scanned['reused'] += 1
+                    scanned['blocks'][h] = cached_blocks[h]
+                else:
+                    scanned['blocks'][h] = parse_index_metadata(m.groups()[0], block)
+                scanned['index_details'][m.groups()] = scanned['blocks'][h]
+    return scanned
+
+
+def schema_snapshot(scanned):
+    """Returns the hashes of every table(covering its ADD TABLE and ADD FIELD statements) and index found by scan_df, in the form stored
+    in the parse cache and compared by diff_schema.
+    """
+    snapshot = {"tables": {}, "indexes": {}}
+    for table_name in scanned['tables']:
+        field_hashes = scanned['field_hashes'].get(table_name, [])
+        snapshot['tables'][table_name] = {
+            "hash": block_hash([scanned['table_hashes'][table_name]] + field_hashes),
+            "fields": field_hashes,
+        }
+    for (index_name, table_name), h in scanned['index_hashes'].items():
+        snapshot['indexes']['%s ON %s' % (index_name, table_name)] = h
+    return snapshot
+
+
+def diff_schema(cache, scanned):
+    """Compares the snapshot stored in cache by a previous run with the current scan, returning a dictionary of added, changed and
+    dropped tables, columns("table.column") and indexes("index ON table").
+    """
+    old = cache['snapshot']
+    new = schema_snapshot(scanned)
+    report = {}
+    for kind in ("tables", "columns", "indexes"):
+        report[kind] = {"added": [], "changed": [], "dropped": []}
+
+    def columns(field_hashes, blocks):
+        return dict([(blocks[h]['name'], blocks[h]) for h in field_hashes if h in blocks])
+
+    for table_name in new['tables']:
+        if table_name not in old['tables']:
+            report['tables']['added'].append(table_name)
+        elif new['tables'][table_name]['hash'] != old['tables'][table_name]['hash']:
+            report['tables']['changed'].append(table_name)
+            old_columns = columns(old['tables'][table_name]['fields'], cache['blocks'])
+            new_columns = columns(new['tables'][table_name]['fields'], scanned['blocks'])
+            for col_name in new_columns:
+                if col_name not in old_columns:
+                    report['columns']['added'].append("%s.%s" % (table_name, col_name))
+                elif new_columns[col_name] != old_columns[col_name]:
+                    report['columns']['changed'].append("%s.%s" % (table_name, col_name))
+            for col_name in old_columns:
+                if col_name not in new_columns:
+                    report['columns']['dropped'].append("%s.%s" % (table_name, col_name))
+    for table_name in old['tables']:
+        if table_name not in new['tables']:
+            report['tables']['dropped'].append(table_name)
+
+    for index in new['indexes']:
+        if index not in old['indexes']:
+            report['indexes']['added'].append(index)
+        elif new['indexes'][index] != old['indexes'][index]:
+            report['indexes']['changed'].append(index)
+    for index in old['indexes']:
+        if index not in new['indexes']:
+            report['indexes']['dropped'].append(index)
+    return report
+
+
+def read_cache(filename):
+    """Returns the parse cache written by write_cache, or an empty cache if filename does not exist yet.
+    """
+    try:
+        f = open(filename, 'r', encoding="latin_1")
+        cache = json.loads(f.read())
+        f.close()
+        return cache
+    except FileNotFoundError as e:
+        return {"blocks": {}, "snapshot": None}
+    except (IOError, ValueError) as e:
+        print("Could not read cache '%s'! Error: %s" % (filename, e))
+        sys.exit(1)
 
 
-def parse_table_names(df):
-    df = re.sub('\n', '_EOL_', df)
-    tables = re.findall(r'ADD TABLE "(.+?)".*?_EOL_(.*?)_EOL__EOL_', df)
-    return tables
+def write_cache(filename, scanned):
+    """Writes the parsed statements of scanned, keyed by the hash of their text, along with the schema snapshot for the next diff.
+    """
+    write_ddl(filename, json.dumps({"blocks": scanned['blocks'], "snapshot": schema_snapshot(scanned)}))
 
 
 def parse_index_metadata(index_name, lines):
@@ -98,20 +226,6 @@ def parse_index_metadata(index_name, lines):
     return meta_data
 
 
-def parse_table_fields(iteration, total_tables, table_name, df):
-    print("(%s/%s) Parsing table '%s'" % (iteration, total_tables, table_name))
-    lines = df.split('\n')
-    pat = r'^ADD FIELD "(.+?)" OF "%s" AS (.+?) $' % table_name
-    columns = []
-    for i in range(0, len(lines)):
-        m = re.search(pat, lines[i])
-        if m is None:
-            continue
-        else:
-            columns.append(parse_table_col_metadata(m.groups()[0], m.groups()[1], lines[i+1:i+20]))
-    return {"name": table_name, "columns": columns}
-
-
 def parse_table_col_metadata(col_name, col_type, lines):
     tests = [
         {
@@ -185,47 +299,36 @@ def parse_table_col_metadata(col_name, col_type, lines):
 
 
 def main():
-    def do_tables(df, processes, excluded_tables):
-        tables = parse_table_names(df)
-
-        # Remove tables which are excluded
-        to_remove = []
-        for i in range(0, len(tables)):
-            table_name, table_metadata = tables[i]
+    def do_tables(scanned, excluded_tables):
+        tables = []
+        for table_name in scanned['tables']:
+            excluded = False
             for pat in excluded_tables:
                 if re.match(pat, table_name, re.I) is not None:
                     print("Skipping table '%s'. Table name matches exclusion '%s'." % (table_name, pat))
-                    to_remove.append(i)
+                    excluded = True
                     break
-        to_remove.reverse()
-        for index in to_remove:
-            tables.pop(index)
+            if excluded is False:
+                tables.append(table_name)
 
         print("Identified %s tables tables to parse." % len(tables))
-        pool = Pool(processes=processes)
-        pool_results = []
+        results = []
         for i in range(0, len(tables)):
-            table_name, table_metadata = tables[i]
-            pool_results.append(pool.apply_async(parse_table_fields, [i+1, len(tables), table_name, df]))
-        pool.close()
-        pool.join()
-        return [r.get() for r in pool_results]
-
-    def do_indexes(df, processes, excluded_tables, excluded_indexes):
-        indexes = parse_index_names(df)
+            print("(%s/%s) Parsing table '%s'" % (i+1, len(tables), tables[i]))
+            results.append({"name": tables[i], "columns": scanned['fields'].get(tables[i], [])})
+        return results
 
-        # Remove indexes on tables which are excluded
-        to_remove = []
-        for i in range(0, len(indexes)):
-            index_name, table_name = indexes[i]
+    def do_indexes(scanned, excluded_tables, excluded_indexes):
+        indexes = []
+        for index_name, table_name in scanned['indexes']:
+            excluded = False
             for pat in excluded_tables:
                 if re.match(pat, table_name) is not None:
                     print("Skipping index '%s' on table '%s'. Table name matches exclusion '%s'." % (index_name, table_name, pat))
-                    to_remove.append(i)
+                    excluded = True
                     break
-        to_remove.reverse()
-        for index in to_remove:
-            indexes.pop(index)
+            if excluded is False:
+                indexes.append((index_name, table_name))
 
         # Remove indexes which are excluded
         to_remove = []
@@ -241,20 +344,22 @@ def main():
             indexes.pop(index)
 
         print("Identified %s indexes to parse." % len(indexes))
-        pool = Pool(processes=processes)
-        pool_results = []
+        results = []
         for i in range(0, len(indexes)):
             index_name, table_name = indexes[i]
-            pool_results.append(pool.apply_async(parse_index_fields, [i+1, len(indexes), index_name, table_name, df]))
-        pool.close()
-        pool.join()
-        return [r.get() for r in pool_results]
+            print("(%s/%s) Parsing index '%s' on table '%s'" % (i+1, len(indexes), index_name, table_name))
+            results.append({"index_name": index_name, "table_name": table_name, "index_details": scanned['index_details'].get(indexes[i])})
+        return results
 
     parser = argparse.ArgumentParser(description="Convert DF format to intermediate DDL")
     parser_required = parser.add_argument_group("required arguments")
     parser_required.add_argument("--input", type=str, required=True, help="input file containing progress DDL (eg 'dbname.df')")
     parser_required.add_argument("--output", type=str, required=True, help="output file for intermediate DDL")
-    parser.add_argument("--concurrency", metavar='N', type=int, default=1, help="concurrency factor for multiple cpus (default: 1)")
+    parser.add_argument("--concurrency", metavar='N', type=int, default=1, help="ignored, the .df is parsed in a single pass (default: 1)")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="cache file of parsed statements, so only changed tables and indexes are re-parsed and reported (default: none)")
+    parser.add_argument("--diff-output", type=str, default=None,
+                        help="output file for a JSON report of tables, columns and indexes changed since the cache was written (requires --cache)")
     parser.add_argument("--skip-indexes", action="store_const", const=True, default=False, help="skip indexes (default: false)")
     parser.add_argument("--skip-tables", action="store_const", const=True, default=False,  help="skip tables (default: false)")
     parser.add_argument("--exclude-table", metavar="<pattern>", action="append", type=str, default=[], help="exclude tables matching regex pattern (can be repeated to exclude multiple patterns)")
@@ -262,16 +367,32 @@ def main():
     parsed_args = vars(parser.parse_args())
 
     df = read_df(parsed_args['input'])
+    if parsed_args['cache'] is not None:
+        cache = read_cache(parsed_args['cache'])
+        scanned = scan_df(df, cache['blocks'])
+        print("Reused %s of %s cached statements from '%s'." % (scanned['reused'], len(scanned['blocks']), parsed_args['cache']))
+        if cache['snapshot'] is not None:
+            report = diff_schema(cache, scanned)
+            for kind, noun in (("tables", "table"), ("columns", "column"), ("indexes", "index")):
+                for change in ("added", "changed", "dropped"):
+                    for name in report[kind][change]:
+                        print("Schema diff: %s %s '%s'." % (change, noun, name))
+            if parsed_args['diff_output'] is not None:
+                write_ddl(parsed_args['diff_output'], json.dumps(report, indent=4))
+                print("Wrote schema diff to '%s'." % parsed_args['diff_output'])
+        write_cache(parsed_args['cache'], scanned)
+    else:
+        scanned = scan_df(df)
 
     if parsed_args['skip_indexes'] is True:
         indexes = []
     else:
-        indexes = do_indexes(df, parsed_args['concurrency'], parsed_args['exclude_table'], parsed_args['exclude_index'])
+        indexes = do_indexes(scanned, parsed_args['exclude_table'], parsed_args['exclude_index'])
 
     if parsed_args['skip_tables'] is True:
         tables = []
     else:
-        tables = do_tables(df, parsed_args['concurrency'], parsed_args['exclude_table'])
+        tables = do_tables(scanned, parsed_args['exclude_table'])
 
     ddl = json.dumps({"indexes": indexes, "tables": tables})
 
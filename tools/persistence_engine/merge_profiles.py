@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import glob
+import json
+import pstats
+
+
+def merge_stages(filenames):
+    """Returns {stage: [seconds, count]} summed over the stages_<pid>.json files written by persistence_engine --profile.
+    """
+    stages = {}
+    for filename in filenames:
+        try:
+            f = open(filename, 'r')
+            dump = json.loads(f.read())
+            f.close()
+        except (IOError, ValueError) as e:
+            print("Skipping unreadable stage file '%s'. Error: %s" % (filename, e))
+            continue
+        for stage, (seconds, count) in dump['stages'].items():
+            if stage not in stages:
+                stages[stage] = [0.0, 0]
+            stages[stage][0] += seconds
+            stages[stage][1] += count
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the per-process profiles written by persistence_engine --profile")
+    parser_required = parser.add_argument_group("required arguments")
+    parser_required.add_argument("--profiledir", type=str, required=True, help="directory given to persistence_engine --profile")
+    parser.add_argument("--output", type=str, default="",
+                        help="write the merged cProfile stats to this file, for use with pstats or snakeviz (default: none)")
+    parser.add_argument("--sort", type=str, default="cumulative", help="pstats sort key for the printed functions (default: cumulative)")
+    parser.add_argument("--limit", metavar='N', type=int, default=30, help="functions to print (default: 30)")
+    parsed_args = vars(parser.parse_args())
+
+    profiles = sorted(glob.glob(parsed_args['profiledir'] + "/profile_*.prof"))
+    stage_files = sorted(glob.glob(parsed_args['profiledir'] + "/stages_*.json"))
+    if len(profiles) == 0:
+        print("No profiles found in '%s'." % parsed_args['profiledir'])
+        sys.exit(1)
+
+    stages = merge_stages(stage_files)
+    total = sum([seconds for seconds, count in stages.values()])
+    print("Stage times from %s processes:" % len(stage_files))
+    for stage, (seconds, count) in sorted(stages.items(), key=lambda s: s[1][0], reverse=True):
+        print("  %-10s %12.3fs %6.1f%% %10s calls %10.3fms/call" % (stage, seconds, (seconds / total * 100) if total > 0 else 0,
+                                                                    count, (seconds / count * 1000) if count > 0 else 0))
+    print("")
+
+    stats = None
+    merged = 0
+    for filename in profiles:
+        try:
+            if stats is None:
+                stats = pstats.Stats(filename)
+            else:
+                stats.add(filename)
+        except (IOError, EOFError, ValueError, TypeError) as e:
+            print("Skipping unreadable profile '%s'. Error: %s" % (filename, e))
+            continue
+        merged += 1
+    if stats is None:
+        print("No readable profiles found in '%s'." % parsed_args['profiledir'])
+        sys.exit(1)
+    if parsed_args['output'] != "":
+        stats.dump_stats(parsed_args['output'])
+        print("Wrote merged profile of %s processes to '%s'." % (merged, parsed_args['output']))
+    stats.sort_stats(parsed_args['sort']).print_stats(parsed_args['limit'])
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.version_info[0] < 3:
+        print("Python 3 or greater is required.")
+        sys.exit(1)
+
+    main()
@@ -12,6 +12,25 @@ import datetime
 import base64
 import traceback
 import socket
+import select
+import struct
+import heapq
+import fnmatch
+import mmap
+import operator
+import bisect
+import cProfile
+import contextlib
+import multiprocessing.util
+import threading
+import tempfile
+import http.server
+import socketserver
+try:  # The packed DDL format is defined by pack_ddl alone, which lives in ../generate_rdbms_ddl unless installed
+    from pack_ddl import is_ddl_pack, read_ddl_pack_header, read_ddl_pack_section
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "generate_rdbms_ddl"))
+    from pack_ddl import is_ddl_pack, read_ddl_pack_header, read_ddl_pack_section
 
 
 def read_ddl(filename):
@@ -25,206 +44,1604 @@ def read_ddl(filename):
         sys.exit(1)
 
 
-def persist_row_mysql(ddl, op, table, epoch, rows, fileseq, process_num=0):
-    """Persists data from filename into MySQL. Returns dictionary containing summary of persist operation.
+profile_state = {"profiler": None, "pid": None, "stages": {}, "last_dump": 0}  # Per process, see --profile
+
+
+def profile_start(ddl):
+    """Starts profiling this process with cProfile when --profile is given. A profiler inherited through fork() is replaced, so each
+    worker process only reports its own work. Profiles are written every --profilesecs and when the process exits, see profile_dump.
+    """
+    if (ddl['args']['profile'] == "") or (profile_state['pid'] == os.getpid()):
+        return
+    if profile_state['profiler'] is not None:
+        profile_state['profiler'].disable()
+    os.makedirs(ddl['args']['profile'], exist_ok=True)
+    profile_state['pid'] = os.getpid()
+    profile_state['stages'] = {}
+    profile_state['profiler'] = cProfile.Profile()
+    profile_state['profiler'].enable()
+    profile_state['last_dump'] = time.time()
+    multiprocessing.util.Finalize(None, profile_dump, args=(ddl,), exitpriority=10)  # Also run by pool workers, unlike atexit
+
+
+def profile_add(stage, started):
+    """Adds the perf_counter() time since started to stage, when profiling.
+    """
+    if profile_state['profiler'] is None:
+        return
+    elapsed = time.perf_counter() - started
+    if stage not in profile_state['stages']:
+        profile_state['stages'][stage] = [0.0, 0]
+    profile_state['stages'][stage][0] += elapsed
+    profile_state['stages'][stage][1] += 1
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile_add(stage, started)
+
+
+def profile_dump(ddl):
+    """Writes the cProfile stats and stage times of this process to --profile as profile_<pid>.prof and stages_<pid>.json, replacing
+    the previous dump. Each file is written under a temporary name and renamed into place, so merge_profiles.py, which combines the
+    files from every process, never reads one half written.
+    """
+    if profile_state['profiler'] is None:
+        return
+    pid = os.getpid()
+    profile_state['profiler'].disable()
+    try:
+        filename = "%s/profile_%s.prof" % (ddl['args']['profile'], pid)
+        profile_state['profiler'].dump_stats(filename + "_partial")
+        os.rename(filename + "_partial", filename)
+        filename = "%s/stages_%s.json" % (ddl['args']['profile'], pid)
+        f = open(filename + "_partial", 'w')
+        f.write(json.dumps({"pid": pid, "stages": profile_state['stages']}))
+        f.close()
+        os.rename(filename + "_partial", filename)
+    except IOError as e:
+        print("!!! Could not write profile to '%s'. Error: %s" % (ddl['args']['profile'], e))
+    profile_state['profiler'].enable()
+    profile_state['last_dump'] = time.time()
+
+
+def profile_maybe_dump(ddl):
+    if (profile_state['profiler'] is not None) and (time.time() - profile_state['last_dump'] >= ddl['args']['profilesecs']):
+        profile_dump(ddl)
+
+
+MYSQL_RECONNECT_ERRORS = (2006, 2013)  # "MySQL server has gone away" and "Lost connection to MySQL server during query"
+
+
+def mysql_connect(ddl):
+    import pymysql
+    import pymysql.cursors
+    mysql_dbkeywords = {
+                        "host": ddl['config']['dbhost'],
+                        "port": ddl['config']['dbport'],
+                        "user": ddl['config']['dbuser'],
+#                        "passwd": ddl['config']['dbpass'],
+                        "db": ddl['config']['dbname'],
+                        "charset": "utf8",
+                        "cursorclass": pymysql.cursors.DictCursor
+                       }
+    if ddl['args']['bulkload'] is True:
+        mysql_dbkeywords['local_infile'] = True
+    conn = pymysql.connect(**mysql_dbkeywords)
+    if ddl['args']['fastinsert'] is False:
+        conn.autocommit(1)
+    return conn
+
+
+def mysql_begin(conn):
+    conn.begin()  # Holds autocommit off until the next commit
+
+
+def mysql_ping(conn):
+    conn.ping(reconnect=False)
+
+
+def mysql_reconnect_error(e):
+    """Returns True if e means MySQL dropped the connection(eg timeout), so the statement can be retried on a new one.
+    """
+    import pymysql
+    return isinstance(e, pymysql.err.OperationalError) and (e.args[0] in MYSQL_RECONNECT_ERRORS)
+
+
+def mysql_prepare_table(ddl, conn, cur, table_local):
+    pass  # Tables are created ahead of time from generate_mysql_db output
+
+
+def mysql_write_sql(ddl, name_local, colnames):
+    """Returns (sql, sql_suffix) for a multi-row INSERT of colnames into name_local, the VALUES lists going between the two.
+    """
+    if ddl['args']['fastinsert'] is True:
+        return "INSERT IGNORE INTO %s (%s) VALUES " % (name_local, ", ".join(colnames)), ""
+    # Upsert guarded on repl_epoch, so a row changed by someone else since fetch_epochs is never overwritten with older data.
+    # MySQL assigns left to right, which is why repl_epoch must be compared before it is updated last.
+    guarded = ["%(c)s = IF(VALUES(repl_epoch) > repl_epoch, VALUES(%(c)s), %(c)s)" % {"c": c}
+               for c in colnames if (c != "repl_recid") and (c != "repl_epoch")]
+    guarded.append("repl_epoch = IF(VALUES(repl_epoch) > repl_epoch, VALUES(repl_epoch), repl_epoch)")
+    return "INSERT INTO %s (%s) VALUES " % (name_local, ", ".join(colnames)), " ON DUPLICATE KEY UPDATE " + ", ".join(guarded)
+
+
+TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})  # LOAD DATA's default ESCAPED BY '\\'
+
+
+def mysql_tombstone_sql():
+    """Returns (sql, sql_suffix) for a multi-row INSERT into TOMBSTONE_TABLE keeping the highest repl_epoch of each row.
+    """
+    return "INSERT INTO %s (table_name, repl_recid, repl_epoch) VALUES " % TOMBSTONE_TABLE, \
+           " ON DUPLICATE KEY UPDATE repl_epoch = GREATEST(repl_epoch, VALUES(repl_epoch))"
+
+
+def tsv_value(value):
+    """Returns value as a LOAD DATA field, NULL being written as \\N and logicals as 1 or 0 like pymysql sends them to INSERT.
+    """
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "1"
+    if value is False:
+        return "0"
+    return str(value).translate(TSV_ESCAPES)
+
+
+def mysql_bulk_load(ddl, cur, name_local, colnames, values):
+    """Loads values, lists of values in colnames order from a write plan's extract, with LOAD DATA LOCAL INFILE ... IGNORE. Rows are
+    streamed as TSV through a FIFO while the server reads them, so they are never written to disk. Returns the rows inserted, rows
+    whose repl_recid is already present being skipped as with --fastinsert.
+    """
+    fifo_dir = tempfile.mkdtemp(prefix="proreptk_bulkload_")
+    fifo = fifo_dir + "/rows.tsv"
+    os.mkfifo(fifo)
+    abandoned = []
+
+    def write_rows():
+        try:
+            f = open(fifo, 'wb')  # Blocks until pymysql opens the FIFO to send it
+            for i in range(0, len(values), 1000):
+                if len(abandoned) != 0:
+                    break
+                f.write("".join(["\t".join([tsv_value(v) for v in row]) + "\n" for row in values[i:i+1000]]).encode("utf-8"))
+            f.close()
+        except BrokenPipeError as e:  # LOAD DATA failed part way through, the error is raised by cur.execute
+            pass
+
+    writer = threading.Thread(target=write_rows)
+    writer.start()
+    try:
+        cur.execute("LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE " + name_local + " CHARACTER SET utf8 (" + ", ".join(colnames) + ")", [fifo])
+    finally:
+        if writer.is_alive():  # LOAD DATA failed before reading every row, so read the rest here until the writer gives up
+            abandoned.append(True)
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            while writer.is_alive():
+                try:
+                    if os.read(fd, 65536) == b"":  # The writer has not opened the FIFO yet
+                        time.sleep(0.01)
+                except BlockingIOError as e:
+                    time.sleep(0.01)
+            os.close(fd)
+        writer.join()
+        os.remove(fifo)
+        os.rmdir(fifo_dir)
+    return cur.rowcount
+
+
+SQLITE_MIN_VERSION = (3, 24, 0)  # The first with INSERT ... ON CONFLICT DO UPDATE, see sqlite_write_sql
+
+SQLITE_TYPES = {
+    "character": "TEXT",
+    "logical": "INTEGER",
+    "decimal": "NUMERIC",
+    "float": "REAL",
+    "raw": "TEXT",
+    "int64": "INTEGER",
+    "integer": "INTEGER",
+    "recid": "INTEGER",
+    "datetime": "TEXT",
+    "date": "TEXT",
+    "clob": "TEXT",
+    "blob": "BLOB",
+}
+
+
+def sqlite_connect(ddl):
+    import sqlite3
+    conn = sqlite3.connect(ddl['args']['sqlitedb'], timeout=60)  # Worker processes take turns writing, waiting up to 60s for the lock
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer, and each commit is an append rather than a rewrite
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def sqlite_begin(conn):
+    pass  # The sqlite3 module opens a transaction before the first write
+
+
+def sqlite_ping(conn):
+    conn.execute("SELECT 1")
+
+
+def sqlite_reconnect_error(e):
+    return False  # A local file can't drop the connection
+
+
+def sqlite_prepare_table(ddl, conn, cur, table_local):
+    """Creates the table for table_local if it doesn't exist yet, with every column from the DDL, as SQLite has no separate step
+    like generate_mysql_db to create them ahead of time.
+    """
+    columns = ["repl_recid INTEGER PRIMARY KEY NOT NULL", "repl_epoch INTEGER NOT NULL"]
+    for column in table_local['columns'].values():
+        if 'extent' in column:  # Extents are stored joined, see get_write_plan
+            columns.append("%s TEXT" % column['name_local'])
+        else:
+            columns.append("%s %s" % (column['name_local'], SQLITE_TYPES.get(column['type_orig'], "TEXT")))
+    cur.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table_local['name_local'], ", ".join(columns)))
+
+
+def sqlite_write_sql(ddl, name_local, colnames):
+    if ddl['args']['fastinsert'] is True:
+        return "INSERT OR IGNORE INTO %s (%s) VALUES " % (name_local, ", ".join(colnames)), ""
+    # Unlike MySQL, SQLite evaluates every SET against the old row, so the epoch guard can be a single WHERE clause
+    updates = ["%(c)s = excluded.%(c)s" % {"c": c} for c in colnames if c != "repl_recid"]
+    return "INSERT INTO %s (%s) VALUES " % (name_local, ", ".join(colnames)), \
+           " ON CONFLICT(repl_recid) DO UPDATE SET %s WHERE excluded.repl_epoch > %s.repl_epoch" % (", ".join(updates), name_local)
+
+
+def sqlite_tombstone_sql():
+    return "INSERT INTO %s (table_name, repl_recid, repl_epoch) VALUES " % TOMBSTONE_TABLE, \
+           " ON CONFLICT(table_name, repl_recid) DO UPDATE SET repl_epoch = excluded.repl_epoch" \
+           " WHERE excluded.repl_epoch > %s.repl_epoch" % TOMBSTONE_TABLE
+
+
+# Everything persist_row_db needs to know about a database. "placeholder" is the driver's parameter marker, "max_params" the most
+# parameters one statement may carry(0 for no limit beyond --batchbytes), "autocommit" whether each statement commits on its own, and
+# "bulk_load" the loader used for insert files by --bulkload, or None if the database has none.
+DB_BACKENDS = {
+    "mysql": {
+        "connect": mysql_connect,
+        "begin": mysql_begin,
+        "ping": mysql_ping,
+        "reconnect_error": mysql_reconnect_error,
+        "prepare_table": mysql_prepare_table,
+        "write_sql": mysql_write_sql,
+        "tombstone_sql": mysql_tombstone_sql,
+        "placeholder": "%s",
+        "max_params": 0,
+        "autocommit": True,
+        "bulk_load": mysql_bulk_load,
+    },
+    "sqlite": {
+        "connect": sqlite_connect,
+        "begin": sqlite_begin,
+        "ping": sqlite_ping,
+        "reconnect_error": sqlite_reconnect_error,
+        "prepare_table": sqlite_prepare_table,
+        "write_sql": sqlite_write_sql,
+        "tombstone_sql": sqlite_tombstone_sql,
+        "placeholder": "?",
+        "max_params": 999,  # SQLITE_MAX_VARIABLE_NUMBER before SQLite 3.32, which older builds still have
+        "autocommit": False,
+        "bulk_load": None,
+    },
+}
+
+
+def db_backend(ddl):
+    return DB_BACKENDS[ddl['args']['backend']]
+
+
+# The newest repl_epoch each deleted row was deleted at. A write reaching the engine after a newer delete of its row(eg from a
+# --batchrows trigger buffer flushed late, or a file retried) finds no row to compare epochs with, and is checked against this instead.
+TOMBSTONE_TABLE = "repl_tombstones"
+
+
+def create_tombstone_table(ddl):
+    """Creates TOMBSTONE_TABLE if it doesn't exist yet. Done once at startup, as MySQL commits any open transaction on CREATE TABLE.
+    """
+    spid = "tombstones"
+    conn, cur = db_checkout(ddl, spid)
+    cur.execute("CREATE TABLE IF NOT EXISTS " + TOMBSTONE_TABLE + " (table_name VARCHAR(64) NOT NULL, repl_recid BIGINT NOT NULL, "
+                "repl_epoch BIGINT NOT NULL, PRIMARY KEY (table_name, repl_recid))")
+    conn.commit()
+    db_checkin(cur)
+
+
+# Connection reused by every persist_row_db call in this process
+db_pool = {"conn": None, "pid": None, "last_used": 0, "dirty": False, "reconnects": 0, "tables": set(),
+           "group": False, "in_txn": False, "group_started": None, "group_rows": 0, "group_files": []}  # See --groupcommit
+
+
+def db_connect(ddl, spid):
+    """Opens a new database connection, replacing the pooled connection of this process. Returns (conn, cur).
+    """
+    if db_pool['in_txn'] is True:  # Reconnecting would silently lose the group's earlier statements
+        raise RuntimeError("Connection lost inside a --groupcommit transaction")
+    if (db_pool['conn'] is not None) and (db_pool['pid'] == os.getpid()):  # Replacing a connection this process made
+        db_pool['reconnects'] += 1
+    db_close()
+    try:
+        conn = db_backend(ddl)['connect'](ddl)
+        cur = conn.cursor()
+    except Exception as e:
+        print("spid=%s !!! %s connection error: %s" % (spid, ddl['args']['backend'], e))
+        raise e
+    db_pool['conn'] = conn
+    db_pool['pid'] = os.getpid()
+    db_pool['last_used'] = time.time()
+    db_pool['tables'] = set()
+    return conn, cur
+
+
+def db_close():
+    """Closes the pooled connection. A connection inherited from the parent through fork() is only forgotten, never closed.
     """
-    def mysql_connect(ddl):
-        mysql_dbkeywords = {
-                            "host": ddl['config']['dbhost'],
-                            "port": ddl['config']['dbport'],
-                            "user": ddl['config']['dbuser'],
-#                            "passwd": ddl['config']['dbpass'],
-                            "db": ddl['config']['dbname'],
-                            "charset": "utf8",
-                            "cursorclass": pymysql.cursors.DictCursor
-                           }
+    if (db_pool['conn'] is not None) and (db_pool['pid'] == os.getpid()):
         try:
-            conn = pymysql.connect(**mysql_dbkeywords)
-            if ddl['args']['fastinsert'] is False:
-                conn.autocommit(1)
+            db_pool['conn'].close()
+        except Exception as e:
+            pass
+    db_pool['conn'] = None
+
+
+def db_checkout(ddl, spid):
+    """Returns (conn, cur) for the pooled connection of this process. A new connection is made if there is none, if the previous
+    user raised part way through(and may have left uncommitted work behind), or if a connection idle for more than --pingidle
+    seconds fails a ping.
+    """
+    conn = db_pool['conn']
+    if (conn is None) or (db_pool['pid'] != os.getpid()):
+        conn, cur = db_connect(ddl, spid)
+    elif db_pool['dirty'] is True:
+        print("spid=%s !!! Previous use of pooled connection did not finish, reconnecting" % spid)
+        conn, cur = db_connect(ddl, spid)
+    elif time.time() - db_pool['last_used'] > ddl['args']['pingidle']:
+        try:
+            db_backend(ddl)['ping'](conn)
             cur = conn.cursor()
-            return conn, cur
         except Exception as e:
-            print("spid=%s !!! MySQL connection error: %s" % (spid, e))
+            print("spid=%s !!! Pooled connection failed health check, reconnecting. Error: %s" % (spid, e))
+            conn, cur = db_connect(ddl, spid)
+    else:
+        cur = conn.cursor()
+    db_pool['dirty'] = True
+    return conn, cur
+
+
+def db_checkin(cur):
+    """Returns the pooled connection after a successful persist_row_db call.
+    """
+    cur.close()
+    db_pool['dirty'] = False
+    db_pool['last_used'] = time.time()
+
+
+def group_commit_start(ddl):
+    """Makes this process hold persisted rows in one transaction per --groupcommit rows or --groupsecs seconds, when --groupcommit
+    is given. Only for 'tables' workers and --debug, which persist many files they claim themselves in one call, so a file is never
+    split across transactions and nothing is left uncommitted between calls.
+    """
+    db_pool['group'] = ddl['args']['groupcommit'] > 0
+
+
+def group_commit_defer(ddl, filenames, row_count, pid, fileseq):
+    """Releases filenames now, or when grouping, once the open transaction holding their rows has been committed.
+    """
+    if db_pool['group'] is False:
+        for filename in filenames:
+            release_json_file(ddl, filename, pid, fileseq)
+        return
+    if db_pool['group_started'] is None:
+        db_pool['group_started'] = time.time()
+    db_pool['group_files'].extend([(filename, pid, fileseq) for filename in filenames])
+    db_pool['group_rows'] += row_count
+    if (db_pool['group_rows'] >= ddl['args']['groupcommit']) or (time.time() - db_pool['group_started'] >= ddl['args']['groupsecs']):
+        group_commit(ddl)
+
+
+def group_commit(ddl):
+    """Commits the open transaction, then releases every file whose rows it held.
+    """
+    if len(db_pool['group_files']) == 0:
+        return
+    if (db_pool['in_txn'] is True) and (db_pool['pid'] == os.getpid()):
+        with profile_stage("commit"):
+            db_pool['conn'].commit()
+    print("pid=%s Committed %s rows from %s files in one transaction" % (db_pool['group_files'][0][1], db_pool['group_rows'],
+                                                                         len(db_pool['group_files'])))
+    for filename, pid, fileseq in db_pool['group_files']:
+        release_json_file(ddl, filename, pid, fileseq)
+    db_pool['in_txn'] = False
+    db_pool['group_started'] = None
+    db_pool['group_rows'] = 0
+    db_pool['group_files'] = []
+
+
+def group_commit_abort(ddl):
+    """Throws away the open transaction by closing the connection, and unlocks the files whose rows it held so they are tried again.
+    """
+    db_pool['in_txn'] = False
+    db_close()
+    for filename, pid, fileseq in db_pool['group_files']:
+        unlock_json_file(ddl, filename)
+        print("pid=%s !!! Transaction rolled back, unlocked '%s' to be persisted again (file #%s)" % (pid, filename, fileseq))
+    db_pool['group_started'] = None
+    db_pool['group_rows'] = 0
+    db_pool['group_files'] = []
+
+
+write_plans = {}  # Write plans built by get_write_plan, cached for the life of the process
+
+
+def get_write_plan(ddl, plan_key):
+    """Returns the write plan for plan_key, a tuple of (table, op, row keys in the order they appear in the JSON rows), building and
+    caching it on first use. A plan holds the sorted local column names, the backend's INSERT text, and an `extract` function turning a row into
+    the list of values for those columns, with extent arrays joined into strings such as "elem1, elem2, elem3".
+    """
+    if plan_key in write_plans:
+        return write_plans[plan_key]
+    table, op, keys = plan_key
+    table_local = get_loaded_table(ddl, table)
+    local_names = {}
+    for colname in keys:  # Map columns to name_local
+        if colname == "rec_id":
+            local_names[colname] = "repl_recid"
+        elif colname == "epoch_time":
+            local_names[colname] = "repl_epoch"
+        else:
+            local_names[colname] = table_local['columns'][colname]['name_local']
+    source = sorted(keys, key=lambda c: local_names[c])
+    colnames = [local_names[c] for c in source]
+    extents = [i for i in range(0, len(source)) if (source[i] in table_local['columns']) and ('extent' in table_local['columns'][source[i]])]
+    getter = operator.itemgetter(*source)
+
+    def extract(row):
+        values = list(getter(row))
+        for i in extents:
+            values[i] = ", ".join([str(v) for v in values[i]])
+        return values
+
+    backend = db_backend(ddl)
+    sql, sql_suffix = backend['write_sql'](ddl, table_local['name_local'], colnames)
+    max_rows = 0  # Rows one statement can carry, 0 for no limit
+    if backend['max_params'] > 0:
+        max_rows = max(backend['max_params'] // len(colnames), 1)
+
+    write_plans[plan_key] = {
+        "colnames": colnames,
+        "sql": sql,
+        "sql_suffix": sql_suffix,
+        "placeholders": "(%s)" % ",".join([backend['placeholder'] for c in colnames]),
+        "max_rows": max_rows,
+        "extract": extract,
+    }
+    return write_plans[plan_key]
+
+
+def persist_row_db(ddl, op, table, epoch, rows, fileseq, process_num=0):
+    """Persists rows into the database chosen by --backend. Returns dictionary containing summary of persist operation.
+    """
+    def execute(conn, cur, sql, params):
+        """Executes sql, reconnecting and retrying once if the database dropped the connection. Returns the (possibly reconnected) conn and cur.
+        Without autocommit(--fastinsert, or a backend such as sqlite) the statements already sent by this call were lost with the connection,
+        so the error is raised instead, and the caller leaves the file to be persisted again.
+        """
+        try:
+            with profile_stage("network"):
+                cur.execute(sql, params)
+        except Exception as e:  # did the database disconnect us for some reason(eg timeout)?
+            if backend['reconnect_error'](e) is False:
+                raise e
+            if (ddl['args']['fastinsert'] is True) or (backend['autocommit'] is False):
+                print("spid=%s !!! Connection error with uncommitted statements, giving up on this call" % spid)
+                db_close()
+                raise e
+            print("spid=%s !!! Connection error, reconnecting and trying again 1 time" % spid)
+            conn, cur = db_connect(ddl, spid)
+            with profile_stage("network"):
+                cur.execute(sql, params)  # Try once more, and crash if it doesn't work
+        return conn, cur
+
+    def fetch_epochs(conn, cur, table_name, recids):
+        """Returns a dictionary of {repl_recid: repl_epoch} for the rows of recids already present in table_name.
+        """
+        sql = "SELECT repl_recid, repl_epoch FROM " + table_name + " WHERE repl_recid IN (%s)" % ",".join([backend['placeholder'] for r in recids])
+        conn, cur = execute(conn, cur, sql, recids)
+        return conn, cur, dict([(r['repl_recid'], r['repl_epoch']) for r in cur.fetchall()])
+
+    def fetch_tombstones(conn, cur, table_name, recids):
+        """Returns a dictionary of {repl_recid: repl_epoch} for the rows of recids deleted from table_name, see TOMBSTONE_TABLE.
+        """
+        sql = "SELECT repl_recid, repl_epoch FROM " + TOMBSTONE_TABLE + " WHERE table_name = " + backend['placeholder'] + \
+              " AND repl_recid IN (%s)" % ",".join([backend['placeholder'] for r in recids])
+        conn, cur = execute(conn, cur, sql, [table_name] + recids)
+        return conn, cur, dict([(r['repl_recid'], r['repl_epoch']) for r in cur.fetchall()])
+
+    def record_tombstones(conn, cur, tombstones):
+        """Records a list of [table_name, repl_recid, repl_epoch] in TOMBSTONE_TABLE, keeping the newest epoch of each row.
+        """
+        sql, sql_suffix = backend['tombstone_sql']()
+        step = len(tombstones) if backend['max_params'] == 0 else max(backend['max_params'] // 3, 1)
+        for i in range(0, len(tombstones), step):
+            part = tombstones[i:i+step]
+            conn, cur = execute(conn, cur, sql + ",".join(["(%s)" % ",".join([backend['placeholder']] * 3) for t in part]) + sql_suffix,
+                                [v for t in part for v in t])
+        return conn, cur
+
+    def newest_rows(rows):
+        """Returns a list keeping only the newest row for each rec_id(the first one wins a tie), and the number of rows dropped.
+        """
+        newest = {}
+        for row in rows:
+            if (row['rec_id'] not in newest) or (newest[row['rec_id']]['epoch_time'] < row['epoch_time']):
+                newest[row['rec_id']] = row
+        return list(newest.values()), len(rows) - len(newest)
+
+    def flush_batch(conn, cur, batch):
+        """Sends the rows collected in batch as one multi-row INSERT. Returns the (possibly reconnected) conn and cur.
+        """
+        plan = batch['plan']
+        with profile_stage("sql_build"):
+            sql = plan['sql'] + ",".join([plan['placeholders'] for values in batch['values']]) + plan['sql_suffix']
+            params = [v for values in batch['values'] for v in values]
+        try:
+            conn, cur = execute(conn, cur, sql, params)
+        except Exception as e:  # Get some useful output that will get lost in the multiprocessing slew out output otherwise
+            exc_text = """
+spid=%(spid)s !!! Unhandled exception during insert !!!
+table: %(table)s
+rows: %(rows)s
+first row: %(row)s
+sql: %(sql)s
+""" % {"spid": spid, "table": table, "rows": len(batch['values']), "row": batch['values'][0], "sql": plan['sql']}
+            print(exc_text)
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback, limit=100, file=sys.stdout)
+            traceback.print_exception(exc_type, exc_value, exc_traceback, limit=10, file=sys.stdout)
             raise e
+        batch['values'] = []
+        batch['bytes'] = 0
+        return conn, cur
+
+    def flush_batches(conn, cur, batches):
+        for batch in batches.values():
+            if len(batch['values']) != 0:
+                conn, cur = flush_batch(conn, cur, batch)
+        return conn, cur
 
+    started = time.time()
+    reconnects = db_pool['reconnects']
     spid = base64.b16encode(str(datetime.datetime.now().microsecond).encode() + str(base64.b16encode(os.urandom(4))).encode())
     spid = spid.decode()
-    import pymysql
-    import pymysql.cursors
+    backend = db_backend(ddl)
 
-    conn, cur = mysql_connect(ddl) 
+    conn, cur = db_checkout(ddl, spid)
+    if (db_pool['group'] is True) and (db_pool['in_txn'] is False):
+        backend['begin'](conn)
+        db_pool['in_txn'] = True
+    if table not in db_pool['tables']:
+        backend['prepare_table'](ddl, conn, cur, get_loaded_table(ddl, table))
+        db_pool['tables'].add(table)
     inserts = 0  # To report on rows inserted
     updates = 0  # To report on rows updated
     skips = 0  # To report on rows skipped
     deletes = 0
-    if (op == "insert") or (op == "update") or (op =="write"):
-        table_local = ddl['loaded'][table]  # Get name_local for table name
+    row_count = len(rows)
+    batches = {}  # Rows waiting to be sent as multi-row INSERTs, keyed like write_plans
+    applied_epochs = []  # epoch_time of every row written or deleted, for lag_summary
+    if (op == "insert") and (ddl['args']['bulkload'] is True):  # Initial dumps, see --bulkload
+        table_local = get_loaded_table(ddl, table)
+        loads = {}  # Rows to load, keyed like write_plans
         for row in rows:
-            if ddl['args']['fastinsert'] is False:  # Check for existance of row matching the one we are updating/inserting
-                update = False
-                rowcount = cur.execute("SELECT repl_recid, repl_epoch FROM " + table + " WHERE repl_recid = %s LIMIT 1", (row['rec_id'],))
-                if rowcount != 0:
-                    local_row = cur.fetchone()
-                    if local_row['repl_epoch'] >= row['epoch_time']:  # Is replicated row newer than row received?
+            plan_key = (table, op, tuple(row.keys()))
+            if plan_key not in loads:
+                loads[plan_key] = {"plan": get_write_plan(ddl, plan_key), "values": []}
+            mapping_started = time.perf_counter() if profile_state['profiler'] is not None else 0  # Not timed per row unless profiling
+            loads[plan_key]['values'].append(loads[plan_key]['plan']['extract'](row))
+            profile_add("mapping", mapping_started)
+            applied_epochs.append(row['epoch_time'])
+        for load in loads.values():
+            with profile_stage("network"):
+                inserts += backend['bulk_load'](ddl, cur, table_local['name_local'], load['plan']['colnames'], load['values'])
+        skips = row_count - inserts
+
+    elif (op == "insert") or (op == "update") or (op == "write"):
+        table_local = get_loaded_table(ddl, table)  # Get name_local for table name
+        if ddl['args']['fastinsert'] is False:  # Only the newest copy of a row can win, so drop the others before asking the database
+            rows, skips = newest_rows(rows)
+        batchrows = ddl['args']['batchrows']
+        if backend['max_params'] > 0:  # Each chunk's epochs are looked up with one parameter per rec_id, plus the table name for tombstones
+            batchrows = min(batchrows, backend['max_params'] - 1)
+        for i in range(0, len(rows), batchrows):
+            chunk = rows[i:i+batchrows]
+            if ddl['args']['fastinsert'] is False:  # Look up existing epochs for the whole chunk in a single query
+                conn, cur, local_epochs = fetch_epochs(conn, cur, table_local['name_local'], [row['rec_id'] for row in chunk])
+                deleted_epochs = {}
+                missing = [row['rec_id'] for row in chunk if row['rec_id'] not in local_epochs]
+                if len(missing) != 0:  # Rows deleted since this change must stay deleted
+                    conn, cur, deleted_epochs = fetch_tombstones(conn, cur, table_local['name_local'], missing)
+            for row in chunk:
+                if ddl['args']['fastinsert'] is False:
+                    if row['rec_id'] in local_epochs:
+                        if local_epochs[row['rec_id']] >= row['epoch_time']:  # Is replicated row newer than row received?
+                            skips += 1
+                            continue
+                        updates += 1
+                    elif deleted_epochs.get(row['rec_id'], 0) >= row['epoch_time']:  # Was the row deleted after this change?
                         skips += 1
                         continue
-                    else:  # Delete existing row before inserting new one
-                        try:
-                            cur.execute("DELETE FROM " + table + " WHERE repl_recid =%s LIMIT 1", row['rec_id'])
-                        except pymysql.err.OperationalError as e:  # did MySQL disconnect us for some reason(eg timeout)?
-                            print("spid=%s !!! MySQL connection error, reconnecting and trying again 1 time" % spid)
-                            if e[0] == 2013:
-                                conn, cur = mysql_connect(ddl)
-                                cur.execute("DELETE FROM " + table + " WHERE repl_recid =%s LIMIT 1", row['rec_id'])
-                        update = True
-                        updates += 1
-
-                if update is False:
+                    else:
+                        inserts += 1
+                else:
                     inserts += 1
-            else:
-                inserts +=1
-
-            for colname in [c for c in row.keys()]:  # Rename columns to name_local
-                if (colname != "rec_id") and (colname != "epoch_time"):
-                    if 'extent' in table_local['columns'][colname]:  # Join columns that contain arrays into strings such as "elem1, elem2, elem3"
-                        row[colname] = ", ".join([str(v) for v in row[colname]])
-                    row[table_local['columns'][colname]['name_local']] = row.pop(colname)  # Rename column to the (possibly different) new local name
-            row['repl_epoch'] = row.pop('epoch_time')
-            row['repl_recid'] = row.pop('rec_id')
-            if (ddl['args']['fastinsert'] is True) or (ddl['args']['concurrency'] == 'files'):
-                sql = "INSERT IGNORE INTO %s " % table_local['name_local']
-            else:
-                sql = "INSERT INTO %s " % table_local['name_local']
-            colnames = [c for c in row.keys()]  # Convert to list() for .sort method
-            colnames.sort()
-            sql += "(%s) " % ", ".join(colnames)
-            placeholders = ["%s" for col in row]
-            placeholders = ",".join(placeholders)
-            sql += "VALUES (%s)" % placeholders
-            try:
-                cur.execute(sql, [row[c] for c in colnames])
-            except pymysql.err.OperationalError as e:  # did MySQL disconnect us for some reason(eg timeout)?
-                if e[0] == 2013:
-                    conn, cur = mysql_connect(ddl)
-                    cur.execute(sql, [row[c] for c in colnames])  # Try once more, and crash if it doesn't work
-            except Exception as e:  # Get some useful output that will get lost in the multiprocessing slew out output otherwise
-                exc_text = """
-spid=%(spid)s !!! Unhandled exception during MySQL insert !!!
-table: %(table)s
-row: %(row)s
-sql: %(sql)s
-""" % {"spid": spid, "table": table, "row": row, "sql": sql}
-                print(exc_text)
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback, limit=100, file=sys.stdout)
-                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=10, file=sys.stdout)
-                raise e
+                applied_epochs.append(row['epoch_time'])
+
+                plan_key = (table, op, tuple(row.keys()))
+                if plan_key not in batches:
+                    batches[plan_key] = {"plan": get_write_plan(ddl, plan_key), "values": [], "bytes": 0}
+                batch = batches[plan_key]
+                mapping_started = time.perf_counter() if profile_state['profiler'] is not None else 0  # Not timed per row unless profiling
+                values = batch['plan']['extract'](row)
+                profile_add("mapping", mapping_started)
+                batch['values'].append(values)
+                batch['bytes'] += len(repr(values))
+                if (len(batch['values']) >= batchrows) or (batch['bytes'] >= ddl['args']['batchbytes']) or \
+                   (len(batch['values']) == batch['plan']['max_rows']):
+                    conn, cur = flush_batch(conn, cur, batch)
+        conn, cur = flush_batches(conn, cur, batches)
 
     elif op == "delete":
-        for row in rows:
-            rowcount = cur.execute("SELECT repl_recid, repl_epoch FROM " + table + " WHERE repl_recid = %s LIMIT 1", (row['rec_id'],))
-            if rowcount != 0:
-                local_row = cur.fetchone()
-                if local_row['repl_epoch'] >= row['epoch_time']:
+        table_local = get_loaded_table(ddl, table)
+        rows, skips = newest_rows(rows)
+        batchrows = ddl['args']['batchrows']
+        if backend['max_params'] > 0:  # Each chunk's epochs are looked up with one parameter per rec_id, plus the table name for tombstones
+            batchrows = min(batchrows, backend['max_params'] - 1)
+        for i in range(0, len(rows), batchrows):
+            chunk = rows[i:i+batchrows]
+            conn, cur, local_epochs = fetch_epochs(conn, cur, table_local['name_local'], [row['rec_id'] for row in chunk])
+            recids = []
+            tombstones = []
+            for row in chunk:
+                if (row['rec_id'] in local_epochs) and (local_epochs[row['rec_id']] >= row['epoch_time']):
                     skips += 1
                     continue
+                tombstones.append([table_local['name_local'], row['rec_id'], row['epoch_time']])
+                if row['rec_id'] not in local_epochs:  # Row to delete is not present in replication target, yet
+                    skips += 1
                 else:
-                    try:
-                        cur.execute("DELETE FROM " + table + " WHERE repl_recid =%s LIMIT 1", row['rec_id'])
-                    except pymysql.err.OperationalError as e:  # did MySQL disconnect us for some reason(eg timeout)?
-                        print("spid=%s !!! MySQL connection error, reconnecting and trying again 1 time" % spid)
-                        if e[0] == 2013:
-                            conn, cur = mysql_connect(ddl)
-                            cur.execute("DELETE FROM " + table + " WHERE repl_recid =%s LIMIT 1", row['rec_id'])
-                    deletes += 1
-            else:  # Row to delete is not present in replication target
-                skips += 1
+                    recids.append(row['rec_id'])
+                    applied_epochs.append(row['epoch_time'])
+            if len(tombstones) != 0:  # Recorded even for rows not present, so an older write of them arriving later is skipped
+                conn, cur = record_tombstones(conn, cur, tombstones)
+            if len(recids) != 0:
+                sql = "DELETE FROM " + table_local['name_local'] + " WHERE repl_recid IN (%s)" % ",".join([backend['placeholder'] for r in recids])
+                conn, cur = execute(conn, cur, sql, recids)
+                deletes += len(recids)
 
-    if ddl['args']['fastinsert'] is True:
-        conn.commit()
-    cur.close()
-    conn.close()
-    result = {"rows": len(rows), "deletes": deletes, "inserts": inserts, "updates": updates, "skips": skips, "table": table, "op": op, "fileseq": fileseq, "spid": spid, "process_num": process_num}
-    print("spid=%s finished persist_row_mysql, result: %s" % (spid, result))
+    if (db_pool['group'] is False) and ((ddl['args']['fastinsert'] is True) or (backend['autocommit'] is False)):
+        with profile_stage("commit"):
+            conn.commit()
+    db_checkin(cur)
+    result = {"rows": row_count, "deletes": deletes, "inserts": inserts, "updates": updates, "skips": skips, "table": table, "op": op,
+              "fileseq": fileseq, "spid": spid, "process_num": process_num, "elapsed": time.time() - started,
+              "reconnects": db_pool['reconnects'] - reconnects}
+    result.update(lag_summary(applied_epochs))
+    print("spid=%s finished persist_row_db, result: %s" % (spid, result))
+    profile_maybe_dump(ddl)
     return result
 
 
-def process_json_file(ddl, filename, fileseq):
-    """Wraps the persist_row_mysql function, returning the same `result` types.
+LAG_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000, 900000, 3600000, 86400000)  # Upper bounds, plus overflow
+
+
+def lag_summary(epochs):
+    """Returns the replication lag of rows applied now, given their trigger epoch_times in milliseconds, as a dictionary holding a
+    histogram with one count per LAG_BUCKETS_MS bound plus one for anything longer, the total and largest lag, and the newest epoch applied.
+    Lag is clamped at 0, so a Progress clock running ahead of ours can't produce negative lag.
     """
-    pid = base64.b16encode(str(datetime.datetime.now().microsecond).encode() + str(base64.b16encode(os.urandom(4))).encode())
-    pid = pid.decode()
-    print("pid=%s Entered process_json_file for '%s' (file #%s)" % (pid, filename, fileseq))
-    if os.path.isfile(filename + ".lock"):
-        print("pid=%s Skipped '%s', lock exists(file #%s)" % (pid, filename, fileseq))
-        return  [{"rows": 0, "deletes": 0, "inserts": 0, "updates": 0, "skips": 0, "table": table, "op": op, "fileseq": fileseq, "spid": None, "process_num": None}]
+    now_ms = int(time.time() * 1000)
+    buckets = [0] * (len(LAG_BUCKETS_MS) + 1)
+    lag_max = 0
+    lag_sum = 0
+    for epoch in epochs:
+        lag = max(now_ms - epoch, 0)
+        lag_sum += lag
+        if lag > lag_max:
+            lag_max = lag
+        buckets[bisect.bisect_left(LAG_BUCKETS_MS, lag)] += 1
+    return {"lag_buckets": buckets, "lag_sum_ms": lag_sum, "lag_max_ms": lag_max, "newest_epoch": max(epochs) if len(epochs) > 0 else None}
 
-    f = open(filename + ".lock", 'w')
-    f.write("timestamp:" + str(datetime.datetime.now()) + "\nhost:" + socket.gethostname() + "\npid:" + pid + "\n")
-    f.close()
-    f = open(filename, 'r')
-    try:
-        size = os.path.getsize(filename)
-        print("pid=%s Reading %s bytes from '%s'(file #%s)" % (pid, size, filename, fileseq))
-        rows = json.load(f)['tt']
-        f.close()
-        print("pid=%s Read %s rows from '%s'(file #%s)" % (pid, len(rows), filename, fileseq))
-    except Exception as e:
-        print("pid=%s !!! Could not open and/or parse file '%s'. Removing lock but leaving file. Error: %s" % (pid, filename, e))
-        os.remove(filename + ".lock")
-        return  [{"rows": 0, "deletes": 0, "inserts": 0, "updates": 0, "skips": 0, "table": table, "op": op, "fileseq": fileseq, "spid": None, "process_num": None}]
 
+def lag_quantile(buckets, q, lag_max):
+    """Estimates the q quantile of a lag_summary histogram, interpolating within the bucket it falls in. Lags past the last bound
+    are reported as lag_max. Returns None for an empty histogram.
+    """
+    total = sum(buckets)
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    lower = 0
+    for i, count in enumerate(buckets):
+        if (count > 0) and (seen + count >= rank):
+            if i == len(LAG_BUCKETS_MS):
+                return lag_max
+            return int(min(lower + (LAG_BUCKETS_MS[i] - lower) * (rank - seen) / count, lag_max))
+        seen += count
+        if i < len(LAG_BUCKETS_MS):
+            lower = LAG_BUCKETS_MS[i]
+    return lag_max
+
+
+def parse_json_filename(filename):
+    """Returns a tuple of (json_type, table, epoch, op) taken from a JSON filename, or None if it does not follow the naming convention.
+    """
     m = re.search(r'^.*/(t|1)__(.+?)__e__(.+?)__(insert|update|write|delete)\.json$', filename)
     if m is None:
-        print("pid=%s !!! Could not determine metadata from filename '%s'. Removing lock but leaving file" % (pid, filename))
-        os.remove(filename + ".lock")
-        return  [{"rows": 0, "deletes": 0, "inserts": 0, "updates": 0, "skips": 0, "table": None, "op": None, "fileseq": fileseq, "spid": None, "process_num": None}]
+        return None
+    return m.groups()
+
+
+def group_json_files(ddl, files):
+    """Returns a list of lists of files that may be persisted together. With --coalesce N, runs of up to N consecutive files for the same
+    table are grouped whatever their op. Otherwise runs of consecutive delete files for the same table are grouped, up to --deletefiles
+    files per group, so purge bursts are applied as a set. All other files are left in a group of their own.
+    """
+    groups = []
+    prev_meta = None
+    for filename in files:
+        meta = parse_json_filename(filename)
+        if (meta is None) or (prev_meta is None) or (meta[1] != prev_meta[1]):
+            groups.append([filename])
+        elif (ddl['args']['coalesce'] > 0) and (len(groups[-1]) < ddl['args']['coalesce']):
+            groups[-1].append(filename)
+        elif (ddl['args']['coalesce'] == 0) and (meta[3] == "delete") and (prev_meta[3] == "delete") and \
+                (len(groups[-1]) < ddl['args']['deletefiles']):
+            groups[-1].append(filename)
+        else:
+            groups.append([filename])
+        prev_meta = meta
+    return groups
+
+
+def partition_json_groups(groups):
+    """Accepts the groups from group_json_files(), and returns a list of partitions, each a list of groups for a single table in the
+    order they were found. Applying each partition in order on one worker keeps every rec_id in epoch order, while different tables
+    are free to run in parallel. Partitions are returned largest first, so the biggest tables start early instead of holding up the
+    end of the pass.
+    """
+    partitions = {}
+    for group in groups:
+        meta = parse_json_filename(group[0])
+        key = group[0] if meta is None else meta[1]  # Files we can't name a table for are left on their own
+        if key not in partitions:
+            partitions[key] = []
+        partitions[key].append(group)
+    return sorted(partitions.values(), key=lambda p: sum([len(g) for g in p]), reverse=True)
+
+
+def coalesce_rows(file_rows):
+    """Accepts a list of (op, rows) read from files for one table, and returns a dictionary of {op: rows} keeping only the newest change
+    for each rec_id, and the number of rows superseded. A delete wins a tie with a write carrying the same epoch_time.
+    """
+    newest = {}
+    row_count = 0
+    for op, rows in file_rows:
+        row_count += len(rows)
+        for row in rows:
+            current = newest.get(row['rec_id'])
+            if (current is None) or (current[1]['epoch_time'] < row['epoch_time']) or \
+               ((current[1]['epoch_time'] == row['epoch_time']) and (op == "delete")):
+                newest[row['rec_id']] = (op, row)
+    rows_by_op = {}
+    for op, row in newest.values():
+        if op not in rows_by_op:
+            rows_by_op[op] = []
+        rows_by_op[op].append(row)
+    return rows_by_op, row_count - len(newest)
+
+
+def empty_result(table, op, fileseq):
+    return {"rows": 0, "deletes": 0, "inserts": 0, "updates": 0, "skips": 0, "table": table, "op": op, "fileseq": fileseq, "spid": None,
+            "process_num": None, "elapsed": 0, "reconnects": 0,
+            "lag_buckets": [0] * (len(LAG_BUCKETS_MS) + 1), "lag_sum_ms": 0, "lag_max_ms": 0, "newest_epoch": None}
+
+
+chunk_rates = {}  # Rows/sec measured for each table by --adaptive, see tune_chunk_rows
+chunk_workers = {}  # Worker processes each table's chunks may occupy at once with --adaptive, see tune_chunk_workers
+chunk_row_secs = {}  # Lowest seconds per row measured for each table by --adaptive, see tune_chunk_workers
+
+
+def chunk_rows(ddl, table, pid):
+    """Returns the number of rows to hand each worker process at once for table. This is --processrows, unless --adaptive is given,
+    in which case it's the rows a worker is expected to persist in --targetsecs at the rate measured for table so far, within
+    --minrows and --maxrows. Row width and database latency are only seen through that rate, so narrow tables get large chunks,
+    while wide or slow tables are split into smaller ones. How many workers they are spread across is up to table_workers.
+    """
+    if ddl['args']['adaptive'] is False:
+        return ddl['args']['processrows']
+    rate = chunk_rates.get(table)
+    if rate is None:  # Nothing measured yet, start from --processrows
+        rows = ddl['args']['processrows']
     else:
-        json_type = m.groups()[0]
-        table = m.groups()[1]
-        epoch = m.groups()[2]
-        op = m.groups()[3]
+        rows = int(rate * ddl['args']['targetsecs'])
+    rows = min(max(rows, ddl['args']['minrows']), ddl['args']['maxrows'])
+    if rate is not None:
+        print("pid=%s Adaptive chunk size for '%s' is %s rows (%.0f rows/sec measured)" % (pid, table, rows, rate))
+    return rows
+
+
+def tune_chunk_rows(ddl, results):
+    """Folds the rows/sec of each result into chunk_rates, as a moving average so one slow chunk doesn't swing the chunk size. Results
+    for fewer than --minrows rows are ignored, since the fixed cost of a chunk would make their rate look far lower than it is.
+    """
+    if ddl['args']['adaptive'] is False:
+        return
+    for result in results:
+        if (result['rows'] < ddl['args']['minrows']) or (result['elapsed'] <= 0):
+            continue
+        rate = result['rows'] / result['elapsed']
+        if result['table'] in chunk_rates:
+            rate = (chunk_rates[result['table']] * 0.7) + (rate * 0.3)
+        chunk_rates[result['table']] = rate
+
+
+def table_workers(ddl, table):
+    """Returns the number of worker processes the chunks of table may occupy at once, all of --processes unless --adaptive has
+    lowered it, see tune_chunk_workers.
+    """
+    if ddl['args']['adaptive'] is False:
+        return ddl['args']['processes']
+    return chunk_workers.get(table, ddl['args']['processes'])
+
+
+def tune_chunk_workers(ddl, table, results, pid):
+    """Adjusts table_workers for table from the seconds per row of the chunks in results, compared with the lowest measured for table.
+    Rows taking twice as long means the table's workers are mostly waiting on each other(eg row locks, or a saturated database), so
+    the limit is halved, and it's raised by one again while rows are back near their best. The best drifts up by 5% per call, so one
+    unusually fast call can't hold the limit down for good.
+    """
+    if ddl['args']['adaptive'] is False:
+        return
+    measured = [r for r in results if (r['rows'] >= ddl['args']['minrows']) and (r['elapsed'] > 0)]
+    if len(measured) == 0:
+        return
+    row_secs = sum([r['elapsed'] for r in measured]) / sum([r['rows'] for r in measured])
+    best = min(chunk_row_secs.get(table, row_secs) * 1.05, row_secs)
+    chunk_row_secs[table] = best
+    workers = table_workers(ddl, table)
+    if row_secs > best * 2:
+        workers = max(workers // 2, 1)
+    elif row_secs < best * 1.25:
+        workers = min(workers + 1, ddl['args']['processes'])
+    if workers != table_workers(ddl, table):
+        print("pid=%s Adaptive worker limit for '%s' is %s (%.3fms/row, best %.3fms/row)" % (pid, table, workers, row_secs * 1000, best * 1000))
+    chunk_workers[table] = workers
+
+
+def persist_rows(ddl, op, table, epoch, rows, fileseq, pid, pool=None):
+    """Hands rows to persist_row_db, split into chunks of chunk_rows() rows across pool when one is given('rows' concurrency strategy).
+    Returns a list of `result`s.
+    """
+    if pool is None:
+        return [persist_row_db(ddl, op, table, epoch, rows, fileseq)]
+    processrows = chunk_rows(ddl, table, pid)
+    return persist_chunks(ddl, op, table, epoch, (rows[i:i+processrows] for i in range(0, len(rows), processrows)), fileseq, pid, pool)
+
+
+def persist_chunks(ddl, op, table, epoch, chunks, fileseq, pid, pool=None, from_ranges=False):
+    """Hands each list of rows yielded by chunks to persist_row_db, across pool when one is given. Returns a list of `result`s.
+    With from_ranges, chunks yields (filename, start, end, rows) byte ranges from iter_json_ranges instead, which are parsed by the
+    process persisting them. No more than 2 chunks per worker process table_workers() allows are waiting at any time, so chunks can be
+    produced while earlier ones are persisted.
+    """
+    results = []
+    pool_results = []
+    process_num = 0
+    workers = table_workers(ddl, table)
+    for chunk in chunks:
+        process_num += 1
+        if from_ranges is True:
+            filename, start, end, row_count = chunk
+            task, args = worker_persist_json_range, [op, table, epoch, filename, start, end, fileseq, process_num]
+        else:
+            row_count = len(chunk)
+            task, args = worker_persist_row_db, [op, table, epoch, chunk, fileseq, process_num]
+        if (pool is None) and (from_ranges is True):
+            results.append(persist_json_range(ddl, *args))
+            continue
+        elif pool is None:
+            results.append(persist_row_db(ddl, *args))
+            continue
+        while len(pool_results) >= workers * 2:
+            results.append(pool_results.pop(0).get())
+        print("pid=%s Assigning %s rows from '%s'(file #%s) to worker process #%s" % (pid, row_count, table, fileseq, process_num))
+        pool_results.append(pool.apply_async(task, args))
+    results += [r.get() for r in pool_results]
+    tune_chunk_rows(ddl, results)
+    if pool is not None:
+        tune_chunk_workers(ddl, table, results, pid)
+    return results
+
+
+def iter_json_rows(f, readsize=1048576):
+    """Yields the rows of a {"tt": [...]} file one at a time, reading readsize characters at a time, so that only the rows not yet
+    yielded from the current read are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    while buf.find("[") == -1:  # Skip to the start of the row array
+        chunk = f.read(readsize)
+        if chunk == "":
+            raise ValueError("No row array found")
+        buf += chunk
+    pos = buf.find("[") + 1
+    while True:
+        while (pos < len(buf)) and (buf[pos] in " \t\r\n,"):
+            pos += 1
+        if pos == len(buf):
+            chunk = f.read(readsize)
+            if chunk == "":
+                raise ValueError("Unexpected end of file inside row array")
+            buf = chunk
+            pos = 0
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            row, end = decoder.raw_decode(buf, pos)
+        except ValueError as e:  # Row continues past what has been read so far
+            chunk = f.read(readsize)
+            if chunk == "":
+                raise e
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield row
+        pos = end
+
+
+def iter_json_chunks(f, size):
+    """Yields lists of up to size rows from iter_json_rows.
+    """
+    chunk = []
+    started = time.perf_counter()
+    for row in iter_json_rows(f):
+        chunk.append(row)
+        if len(chunk) == size:
+            profile_add("decode", started)
+            yield chunk
+            chunk = []
+            started = time.perf_counter()
+    if len(chunk) != 0:
+        profile_add("decode", started)
+        yield chunk
+
+
+JSON_TOKEN_PATTERN = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')  # Strings are matched whole so brackets inside them are skipped
+JSON_ROW_START_PATTERN = re.compile(rb'\n[ \t]*\{')  # A line opening a row, as written by WRITE-JSON with formatting
+
+
+def iter_json_ranges(filename, size):
+    """Yields (filename, start, end, rows) byte ranges of a {"tt": [...]} file, each covering up to size rows. Rows are never decoded
+    here, so each range can be parsed by the process that persists it. Rows are flat objects, and JSON strings cannot hold a raw newline,
+    so in formatted files, such as the triggers and dumps write, every line starting with "{" starts a row, and a single regular
+    expression finds them all. Files on a single line fall back to iter_json_token_ranges.
+    """
+    f = open(filename, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        array_start = mm.find(b"[")
+        array_end = mm.rfind(b"]")
+        if (array_start == -1) or (array_end < array_start):
+            raise ValueError("No complete row array found")
+        first = mm.find(b"{", array_start, array_end)
+        if first == -1:  # No rows
+            return
+        if mm.find(b"\n", first, array_end) == -1:
+            for chunk in iter_json_token_ranges(filename, mm, size):
+                yield chunk
+            return
+        starts = [first] + [m.end() - 1 for m in JSON_ROW_START_PATTERN.finditer(mm, first + 1, array_end)]
+        for i in range(0, len(starts), size):
+            limit = starts[i + size] if i + size < len(starts) else array_end
+            end = mm.rfind(b"}", starts[i], limit) + 1  # Leave out the comma between rows
+            yield (filename, starts[i], end, len(starts[i:i+size]))
+    finally:
+        mm.close()
+        f.close()
+
+
+def iter_json_token_ranges(filename, mm, size):
+    """Yields the ranges of iter_json_ranges for an unformatted file, by tokenizing its strings, brackets and braces.
+    """
+    depth = 0
+    start = None
+    end = None
+    rows = 0
+    for m in JSON_TOKEN_PATTERN.finditer(mm):
+        c = mm[m.start()]
+        if (c == 0x7b) or (c == 0x5b):  # { or [
+            depth += 1
+            if (depth == 3) and (start is None):
+                start = m.start()
+        elif (c == 0x7d) or (c == 0x5d):  # } or ]
+            depth -= 1
+            if (depth == 2) and (start is not None):
+                rows += 1
+                end = m.end()
+                if rows == size:
+                    yield (filename, start, end, rows)
+                    start = None
+                    rows = 0
+    if depth != 0:
+        raise ValueError("No complete row array found")
+    if rows != 0:
+        yield (filename, start, end, rows)
+
+
+def load_json_range(filename, start, end):
+    """Returns the rows found between byte offsets start and end of filename, as yielded by iter_json_ranges.
+    """
+    f = open(filename, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with profile_stage("decode"):
+            return json.loads((b"[" + mm[start:end] + b"]").decode("utf-8"))
+    finally:
+        mm.close()
+        f.close()
+
+
+def persist_json_range(ddl, op, table, epoch, filename, start, end, fileseq, process_num=0):
+    started = time.time()
+    result = persist_row_db(ddl, op, table, epoch, load_json_range(filename, start, end), fileseq, process_num)
+    result['elapsed'] = time.time() - started  # Include decoding, which is part of the chunk's cost
+    return result
+
 
-    print("pid=%s Persisting %s rows in table '%s'" % (pid, len(rows), table))
+worker_ddl = None  # DDL given once to each long-lived worker process by init_worker, instead of being pickled with every task
 
+
+def init_worker(ddl):
+    global worker_ddl
+    worker_ddl = ddl
+    profile_start(ddl)
+
+
+def worker_persist_row_db(op, table, epoch, rows, fileseq, process_num):
+    return persist_row_db(worker_ddl, op, table, epoch, rows, fileseq, process_num)
+
+
+def worker_persist_json_range(op, table, epoch, filename, start, end, fileseq, process_num):
+    return persist_json_range(worker_ddl, op, table, epoch, filename, start, end, fileseq, process_num)
+
+
+def worker_process_json_files(filenames, fileseq):
+    return process_json_files(worker_ddl, filenames, fileseq)
+
+
+def worker_process_json_partition(groups, fileseq):
+    group_commit_start(worker_ddl)
+    results = []
+    try:
+        for group in groups:
+            fileseq += len(group)
+            results.extend(process_json_files(worker_ddl, group, fileseq))
+        group_commit(worker_ddl)  # Nothing is left open between tasks
+    except Exception as e:
+        group_commit_abort(worker_ddl)
+        raise e
+    return results
+
+
+def start_worker_pool(ddl):
+    """Starts the worker processes used for the life of the engine, or returns None when --debug disables concurrency.
+    """
     if ddl['args']['debug'] is True:
-        ddl['args']['concurrency'] = "files"
+        return None
+    maxtasksperchild = None
+    if ddl['args']['workertasks'] > 0:
+        maxtasksperchild = ddl['args']['workertasks']
+    return Pool(processes=ddl['args']['processes'], initializer=init_worker, initargs=(ddl,), maxtasksperchild=maxtasksperchild)
+
+
+journal = {"fd": None, "filename": None, "claimed": 0}  # See --journal, opened by journal_open before the pool is started
+
+
+def journal_append(lines):
+    """Appends lines to the journal in a single write, so lines from different processes never interleave.
+    """
+    os.write(journal['fd'], "".join(lines).encode())
+
+
+def journal_read(filename):
+    """Returns {json filename: last journal op} for every file in the journal.
+    """
+    last_ops = {}
+    try:
+        f = open(filename, 'r')
+        for line in f:
+            fields = line.rstrip("\n").split(" ", 2)
+            if (len(fields) == 3) and line.endswith("\n"):  # A line cut short by a crash is ignored
+                last_ops[fields[2]] = fields[0]
+        f.close()
+    except IOError as e:
+        pass
+    return last_ops
+
 
-    if ddl['args']['concurrency'] == "rows":
-        if len(rows) == 0:
-            os.remove(filename + ".lock")
-            if ddl['args']['keepjson'] is False:
+def journal_remove_done(ddl, last_ops):
+    """Removes every file the journal records as done, unless --keepjson is set. Returns the number of files removed.
+    """
+    removed = 0
+    if ddl['args']['keepjson'] is True:
+        return removed
+    for filename, op in last_ops.items():
+        if op == "done":
+            try:
                 os.remove(filename)
-            return  [{"rows": 0, "deletes": 0, "inserts": 0, "updates": 0, "skips": 0, "table": table, "op": op, "fileseq": fileseq, "spid": None, "process_num": None}]
-        print("pid=%s Spawning sub-processes to process %s rows in '%s'(file #%s)" % (pid, len(rows), table, fileseq))
-        pool_results = []
-        processrows = ddl['args']['processrows']
-        if processrows > len(rows):
-            pool = Pool(processes=1, maxtasksperchild=5)
-        else:
-            pool = Pool(processes=ddl['args']['processes'], maxtasksperchild=5)
-        process_num = 0
-        for i in range(0, len(rows), processrows):
-            process_num += 1
-            these_rows = rows[i:i+processrows]
-            print("pid=%s Assigning %s rows from '%s'(file #%s) to worker process #%s" % (pid, len(these_rows), table, fileseq, process_num))
-            pool_results.append(pool.apply_async(persist_row_mysql, [ddl, op, table, epoch, these_rows, fileseq, process_num]))
-        pool.close()
-        pool.join()
-        results = [r.get() for r in pool_results]
-    elif ddl['args']['concurrency'] == "files":
-        results = persist_row_mysql(ddl, op, table, epoch, rows, fileseq)
+                removed += 1
+            except FileNotFoundError as e:  # Removed before a crash left the journal untruncated
+                pass
+    return removed
+
+
+def journal_open(ddl):
+    """Opens --journal, which replaces the .lock file kept next to each JSON file. The parent appends one claim line per file before
+    handing files to workers, and whichever process persists a file appends a done line once its rows are committed, or a free line
+    if it has to be retried. Files are only removed by journal_sweep, in a batch at the end of each pass. Left over from a crash,
+    claims without a done line are reclaimed, and done files not yet removed are removed now.
+    """
+    if ddl['args']['journal'] == "":
+        return
+    last_ops = journal_read(ddl['args']['journal'])
+    stale = len([op for op in last_ops.values() if op == "claim"])
+    removed = journal_remove_done(ddl, last_ops)
+    if len(last_ops) != 0:
+        print("Recovered journal '%s', reclaimed %s stale claims and removed %s done files." % (ddl['args']['journal'], stale, removed))
+    journal['filename'] = ddl['args']['journal']
+    journal['fd'] = os.open(journal['filename'], os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o644)
+
+
+def journal_claim(files):
+    """Claims files for this pass with a single append to the journal.
+    """
+    if len(files) != 0:
+        journal_append(["claim %s %s\n" % (time.time(), filename) for filename in files])
+    journal['claimed'] = len(files)
+
+
+def journal_sweep(ddl):
+    """Ends a pass, after every worker task has returned. Flushes the journal to disk, removes done files in a batch, then empties
+    the journal. Claims left without a done line were not persisted and are simply picked up again next pass.
+    """
+    if journal['fd'] is None:
+        return
+    last_ops = journal_read(journal['filename'])
+    os.fsync(journal['fd'])
+    removed = journal_remove_done(ddl, last_ops)
+    released = len([op for op in last_ops.values() if op != "done"])
+    if journal['claimed'] != 0:
+        print("Journal: %s files claimed, %s removed, %s released to be retried." % (journal['claimed'], removed, released))
+    os.ftruncate(journal['fd'], 0)
+    journal['claimed'] = 0
+
+
+def lock_json_file(ddl, filename, pid, fileseq):
+    """Places a lock next to filename, returning False if another process already holds one. With --journal, the parent has
+    already claimed filename in the journal.
+    """
+    if journal['fd'] is not None:
+        return True
+    if os.path.isfile(filename + ".lock"):
+        print("pid=%s Skipped '%s', lock exists(file #%s)" % (pid, filename, fileseq))
+        return False
+    f = open(filename + ".lock", 'w')
+    f.write("timestamp:" + str(datetime.datetime.now()) + "\nhost:" + socket.gethostname() + "\npid:" + pid + "\n")
+    f.close()
+    return True
+
 
+def unlock_json_file(ddl, filename):
+    """Gives up the claim on a file that was not persisted, leaving it to be tried again.
+    """
+    if journal['fd'] is not None:
+        journal_append(["free %s %s\n" % (time.time(), filename)])
+    elif os.path.isfile(filename + ".lock"):
+        os.remove(filename + ".lock")
+
+
+def release_json_file(ddl, filename, pid, fileseq):
+    """Removes the lock of a persisted file, and the file itself unless --keepjson is set. With --journal, the file is only
+    recorded as done here, and is removed by journal_sweep.
+    """
+    if journal['fd'] is not None:
+        journal_append(["done %s %s\n" % (time.time(), filename)])
+        print("pid=%s Journaled '%s' as done (file #%s)" % (pid, filename, fileseq))
+        return
     os.remove(filename + ".lock")
     if ddl['args']['keepjson'] is False:
         os.remove(filename)
         print("pid=%s Removed '%s' and lock (file #%s)" % (pid, filename, fileseq))
     else:
         print("pid=%s Removed lock for '%s' (file #%s)" % (pid, filename, fileseq))
+
+
+def process_json_chunked(ddl, filename, fileseq, pool, pid):
+    """Persists a single file with --jsonreader stream or mmap, handing chunks to persist_chunks while the file is still being read.
+    Returns a list of `result`s.
+    """
+    json_type, table, epoch, op = parse_json_filename(filename)
+    print("pid=%s Entered process_json_chunked for '%s' (file #%s)" % (pid, filename, fileseq))
+    if lock_json_file(ddl, filename, pid, fileseq) is False:
+        return [empty_result(table, op, fileseq)]
+    try:
+        size = os.path.getsize(filename)
+        if ddl['args']['jsonreader'] == "mmap":
+            print("pid=%s Indexing %s bytes from '%s'(file #%s)" % (pid, size, filename, fileseq))
+            chunks = iter_json_ranges(filename, chunk_rows(ddl, table, pid))
+            results = persist_chunks(ddl, op, table, epoch, chunks, fileseq, pid, pool, from_ranges=True)
+        else:
+            print("pid=%s Streaming %s bytes from '%s'(file #%s)" % (pid, size, filename, fileseq))
+            f = open(filename, 'r')
+            results = persist_chunks(ddl, op, table, epoch, iter_json_chunks(f, chunk_rows(ddl, table, pid)), fileseq, pid, pool)
+            f.close()
+    except ValueError as e:  # Rows read before the error have been persisted, persisting them again is harmless
+        print("pid=%s !!! Could not parse file '%s'. Removing lock but leaving file. Error: %s" % (pid, filename, e))
+        unlock_json_file(ddl, filename)
+        return [empty_result(table, op, fileseq)]
+    except Exception as e:
+        print("pid=%s !!! Could not persist file '%s'. Removing lock but leaving file. Error: %s" % (pid, filename, e))
+        unlock_json_file(ddl, filename)
+        raise e
+    print("pid=%s Persisted %s rows from '%s'(file #%s)" % (pid, sum([r['rows'] for r in results]), filename, fileseq))
+    group_commit_defer(ddl, [filename], sum([r['rows'] for r in results]), pid, fileseq)
+    if len(results) == 0:
+        results.append(empty_result(table, op, fileseq))
+    return results
+
+
+def process_json_files(ddl, filenames, fileseq, pool=None):
+    """Wraps the persist_row_db function for a group of files for the same table(see group_json_files), returning a list of
+    `result`s. Files are only removed after the rows of the whole group have been persisted, including files whose rows were all
+    superseded by newer ones. Rows are split across pool if given.
+    """
+    pid = base64.b16encode(str(datetime.datetime.now().microsecond).encode() + str(base64.b16encode(os.urandom(4))).encode())
+    pid = pid.decode()
+    meta = parse_json_filename(filenames[0])
+    if meta is None:
+        print("pid=%s !!! Could not determine metadata from filename '%s'. Leaving file" % (pid, filenames[0]))
+        return [empty_result(None, None, fileseq)]
+    json_type, table, epoch, op = meta
+    if (ddl['args']['jsonreader'] != "load") and (len(filenames) == 1):
+        return process_json_chunked(ddl, filenames[0], fileseq, pool, pid)
+
+    file_rows = []
+    claimed = []
+    for filename in filenames:
+        print("pid=%s Entered process_json_files for '%s' (file #%s)" % (pid, filename, fileseq))
+        if lock_json_file(ddl, filename, pid, fileseq) is False:
+            continue
+        try:
+            f = open(filename, 'r')
+            size = os.path.getsize(filename)
+            print("pid=%s Reading %s bytes from '%s'(file #%s)" % (pid, size, filename, fileseq))
+            with profile_stage("decode"):
+                rows = json.load(f)['tt']
+            f.close()
+            print("pid=%s Read %s rows from '%s'(file #%s)" % (pid, len(rows), filename, fileseq))
+        except Exception as e:
+            print("pid=%s !!! Could not open and/or parse file '%s'. Removing lock but leaving file. Error: %s" % (pid, filename, e))
+            unlock_json_file(ddl, filename)
+            continue
+        file_rows.append((parse_json_filename(filename)[3], rows))
+        claimed.append(filename)
+
+    if len(claimed) == 0:
+        return [empty_result(table, op, fileseq)]
+
+    ops = set([file_op for file_op, rows in file_rows])
+    if len(ops) == 1:
+        rows_by_op = {op: [row for file_op, rows in file_rows for row in rows]}
+        superseded = 0
+    else:  # Mixed ops from --coalesce, only the net change of each rec_id is applied
+        rows_by_op, superseded = coalesce_rows(file_rows)
+        print("pid=%s Coalesced %s files in table '%s', %s superseded rows dropped" % (pid, len(claimed), table, superseded))
+
+    results = []
+    if superseded != 0:
+        result = empty_result(table, "coalesce", fileseq)
+        result['rows'] = superseded
+        result['skips'] = superseded
+        results.append(result)
+    try:
+        for op, rows in rows_by_op.items():
+            if len(rows) != 0:
+                print("pid=%s Persisting %s %s rows from %s file(s) in table '%s'" % (pid, len(rows), op, len(claimed), table))
+                results.extend(persist_rows(ddl, op, table, epoch, rows, fileseq, pid, pool))
+    except Exception as e:  # Rows already applied are skipped by their repl_epoch when the files are persisted again
+        print("pid=%s !!! Could not persist %s file(s) in table '%s'. Removing locks but leaving files. Error: %s" % (pid, len(claimed), table, e))
+        for filename in claimed:
+            unlock_json_file(ddl, filename)
+        raise e
+    if len(results) == 0:
+        results.append(empty_result(table, op, fileseq))
+
+    group_commit_defer(ddl, claimed, sum([r['rows'] for r in results]), pid, fileseq)
     return results
 
 
+IN_MOVED_TO = 0x00000080  # inotify event masks from <sys/inotify.h>
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def inotify_start(ddl):
+    """Starts watching --jsondir for files renamed into place, as done by the ABL triggers with OS-RENAME. Returns a watcher dictionary
+    holding the inotify file descriptor and a priority queue of pending files, to be drained with inotify_wait.
+    """
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    wd = libc.inotify_add_watch(fd, ddl['args']['jsondir'].encode(), IN_MOVED_TO)
+    if wd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_add_watch failed for '%s'" % ddl['args']['jsondir'])
+    return {"fd": fd, "queue": [], "queued": set(), "retry": [], "rescan": True}
+
+
+def inotify_queue(watcher, filename):
+    if filename not in watcher['queued']:
+        watcher['queued'].add(filename)
+        heapq.heappush(watcher['queue'], filename)
+
+
+def inotify_retry(watcher, files):
+    """Queues the files of a finished pass that are still on disk, because they were locked, failed to parse or were released to be
+    retried, to be returned again by the next inotify_wait after its usual wait. This is what the next glob would find without --watch.
+    """
+    watcher['retry'] = [filename for filename in files if os.path.isfile(filename)]
+
+
+def inotify_wait(watcher, ddl, timeout):
+    """Returns pending files in the same order as a sorted glob, waiting up to timeout seconds for one to arrive. The whole directory is
+    only globbed on the first call, and again if the kernel reports that its event queue overflowed. Files from inotify_retry are
+    returned after the wait.
+    """
+    if watcher['rescan'] is True:
+        watcher['rescan'] = False
+        for filename in glob.glob(ddl['args']['jsondir'] + "/" + ddl['args']['globpattern']):
+            inotify_queue(watcher, filename)
+    if len(watcher['queue']) == 0:
+        select.select([watcher['fd']], [], [], timeout)
+    while True:
+        try:
+            buf = os.read(watcher['fd'], 65536)
+        except BlockingIOError:
+            break
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = struct.unpack_from("iIII", buf, offset)
+            name = buf[offset+16:offset+16+length].rstrip(b"\0").decode()
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                print("!!! inotify event queue overflowed, rescanning '%s'" % ddl['args']['jsondir'])
+                watcher['rescan'] = True
+            elif fnmatch.fnmatch(name, ddl['args']['globpattern']):
+                inotify_queue(watcher, ddl['args']['jsondir'] + "/" + name)
+    if watcher['rescan'] is True:
+        return inotify_wait(watcher, ddl, 0)
+    for filename in watcher['retry']:
+        inotify_queue(watcher, filename)
+    watcher['retry'] = []
+    files = []
+    while len(watcher['queue']) != 0:
+        filename = heapq.heappop(watcher['queue'])
+        watcher['queued'].discard(filename)
+        files.append(filename)
+    return files
+
+
+METRICS_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds, upper bounds of the apply latency histogram
+
+metrics = {"files": 0, "queue_files": 0, "oldest_pending_epoch": None, "tables": {}}  # Kept by the parent from `result`s, see --metricsport
+metrics_lock = threading.Lock()
+
+
+def metrics_table(table):
+    if table not in metrics['tables']:
+        metrics['tables'][table] = {"rows": 0, "inserts": 0, "updates": 0, "deletes": 0, "skips": 0, "reconnects": 0,
+                                    "latency_buckets": [0] * len(METRICS_LATENCY_BUCKETS), "latency_sum": 0.0, "latency_count": 0,
+                                    "lag_buckets": [0] * (len(LAG_BUCKETS_MS) + 1), "lag_sum_ms": 0, "lag_max_ms": 0, "newest_epoch": None,
+                                    "pass_lag_buckets": [0] * (len(LAG_BUCKETS_MS) + 1), "pass_lag_max_ms": 0}
+    return metrics['tables'][table]
+
+
+def record_queue(files):
+    """Records the files waiting at the start of a pass, and the epoch of the oldest of them.
+    """
+    epochs = []
+    for filename in files:
+        meta = parse_json_filename(filename)
+        if meta is not None:
+            epoch = re.match(r'\d+', meta[2])
+            if epoch is not None:
+                epochs.append(int(epoch.group(0)))
+    with metrics_lock:
+        metrics['queue_files'] = len(files)
+        metrics['oldest_pending_epoch'] = min(epochs) if len(epochs) > 0 else None
+        for table_metrics in metrics['tables'].values():  # Lag percentiles are reported for each pass, see report_lag
+            table_metrics['pass_lag_buckets'] = [0] * (len(LAG_BUCKETS_MS) + 1)
+            table_metrics['pass_lag_max_ms'] = 0
+
+
+def record_metrics(results, files):
+    """Adds the `result`s returned for a number of persisted files to the metrics. Only results from persist_row_db carry a spid, and
+    only those are counted in the apply latency histogram.
+    """
+    with metrics_lock:
+        metrics['files'] += files
+        metrics['queue_files'] = max(metrics['queue_files'] - files, 0)
+        for result in results:
+            if result['table'] is None:
+                continue
+            table_metrics = metrics_table(result['table'])
+            for key in ('rows', 'inserts', 'updates', 'deletes', 'skips', 'reconnects'):
+                table_metrics[key] += result[key]
+            if result['spid'] is not None:
+                table_metrics['latency_count'] += 1
+                table_metrics['latency_sum'] += result['elapsed']
+                for i, bound in enumerate(METRICS_LATENCY_BUCKETS):
+                    if result['elapsed'] <= bound:
+                        table_metrics['latency_buckets'][i] += 1
+            if result['newest_epoch'] is not None:
+                for i, count in enumerate(result['lag_buckets']):
+                    table_metrics['lag_buckets'][i] += count
+                    table_metrics['pass_lag_buckets'][i] += count
+                table_metrics['lag_sum_ms'] += result['lag_sum_ms']
+                table_metrics['lag_max_ms'] = max(table_metrics['lag_max_ms'], result['lag_max_ms'])
+                table_metrics['pass_lag_max_ms'] = max(table_metrics['pass_lag_max_ms'], result['lag_max_ms'])
+                table_metrics['newest_epoch'] = max(table_metrics['newest_epoch'] or 0, result['newest_epoch'])
+
+
+def render_metrics():
+    """Returns the metrics in the Prometheus text exposition format. Rates such as rows per second are left to rate() in Prometheus.
+    """
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for labels, value in samples:
+            if len(labels) > 0:
+                label_text = ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels])
+                lines.append("%s{%s} %s" % (name, label_text, value))
+            else:
+                lines.append("%s %s" % (name, value))
+
+    with metrics_lock:
+        tables = sorted(metrics['tables'].items())
+        metric("proreptk_files_total", "counter", "JSON files persisted.", [((), metrics['files'])])
+        metric("proreptk_queue_files", "gauge", "JSON files waiting to be persisted in the current pass.", [((), metrics['queue_files'])])
+        oldest = metrics['oldest_pending_epoch']
+        metric("proreptk_oldest_pending_epoch_ms", "gauge", "Epoch of the oldest JSON file waiting in the current pass, 0 if none.",
+               [((), oldest if oldest is not None else 0)])
+        metric("proreptk_oldest_pending_age_seconds", "gauge", "Age of the oldest JSON file waiting in the current pass, 0 if none.",
+               [((), "%.3f" % max(time.time() - (oldest / 1000.0), 0) if oldest is not None else 0)])
+        for key, help_text in (('rows', "Rows read from JSON files."), ('inserts', "Rows inserted."), ('updates', "Rows updated."),
+                               ('deletes', "Rows deleted."), ('skips', "Rows skipped as stale or superseded."),
+                               ('reconnects', "Database reconnects made by worker processes.")):
+            metric("proreptk_%s_total" % key, "counter", help_text, [((('table', t),), m[key]) for t, m in tables])
+        lines.append("# HELP proreptk_apply_seconds Time taken by persist_row_db to apply a chunk of rows.")
+        lines.append("# TYPE proreptk_apply_seconds histogram")
+        for t, m in tables:
+            label = t.replace("\\", "\\\\").replace('"', '\\"')
+            for bound, count in zip(METRICS_LATENCY_BUCKETS, m['latency_buckets']):
+                lines.append('proreptk_apply_seconds_bucket{table="%s",le="%s"} %s' % (label, bound, count))
+            lines.append('proreptk_apply_seconds_bucket{table="%s",le="+Inf"} %s' % (label, m['latency_count']))
+            lines.append('proreptk_apply_seconds_sum{table="%s"} %.6f' % (label, m['latency_sum']))
+            lines.append('proreptk_apply_seconds_count{table="%s"} %s' % (label, m['latency_count']))
+        lines.append("# HELP proreptk_lag_seconds Time from the trigger epoch_time of a row to it being applied.")
+        lines.append("# TYPE proreptk_lag_seconds histogram")
+        for t, m in tables:
+            label = t.replace("\\", "\\\\").replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(LAG_BUCKETS_MS, m['lag_buckets']):
+                cumulative += count
+                lines.append('proreptk_lag_seconds_bucket{table="%s",le="%s"} %s' % (label, bound / 1000.0, cumulative))
+            lines.append('proreptk_lag_seconds_bucket{table="%s",le="+Inf"} %s' % (label, sum(m['lag_buckets'])))
+            lines.append('proreptk_lag_seconds_sum{table="%s"} %.3f' % (label, m['lag_sum_ms'] / 1000.0))
+            lines.append('proreptk_lag_seconds_count{table="%s"} %s' % (label, sum(m['lag_buckets'])))
+        metric("proreptk_newest_applied_epoch_ms", "gauge", "Newest trigger epoch_time applied.",
+               [((('table', t),), m['newest_epoch']) for t, m in tables if m['newest_epoch'] is not None])
+    return "\n".join(lines) + "\n"
+
+
+def report_lag(ddl):
+    """Prints the p50/p99/max replication lag of each table applied during the pass just finished, raising an alarm for any table
+    whose worst lag is over --maxlag seconds, and writes the same figures to --lagtable when given.
+    """
+    status_rows = []
+    now_ms = int(time.time() * 1000)
+    with metrics_lock:
+        for table, m in sorted(metrics['tables'].items()):
+            if sum(m['pass_lag_buckets']) == 0:
+                continue
+            p50 = lag_quantile(m['pass_lag_buckets'], 0.50, m['pass_lag_max_ms'])
+            p99 = lag_quantile(m['pass_lag_buckets'], 0.99, m['pass_lag_max_ms'])
+            print("Replication lag for '%s': p50 %.3fs, p99 %.3fs, max %.3fs" % (table, p50 / 1000.0, p99 / 1000.0, m['pass_lag_max_ms'] / 1000.0))
+            if (ddl['args']['maxlag'] > 0) and (m['pass_lag_max_ms'] > ddl['args']['maxlag'] * 1000):
+                print("!!! Replication lag alarm for '%s': %.3fs is over --maxlag %ss" % (table, m['pass_lag_max_ms'] / 1000.0,
+                                                                                          ddl['args']['maxlag']))
+            status_rows.append([table, m['newest_epoch'], now_ms, p50, p99, m['pass_lag_max_ms'], sum(m['pass_lag_buckets'])])
+    if (ddl['args']['lagtable'] != "") and (len(status_rows) != 0):
+        write_lag_table(ddl, status_rows)
+
+
+def write_lag_table(ddl, status_rows):
+    """REPLACEs one row per table into --lagtable, creating it if needed, so consumers of the replica can tell how fresh each table
+    is. Failures are printed and otherwise ignored, since the status table must never stop replication.
+    """
+    spid = "lagtable"
+    try:
+        conn, cur = db_checkout(ddl, spid)
+        cur.execute("CREATE TABLE IF NOT EXISTS " + ddl['args']['lagtable'] + " (table_name VARCHAR(64) PRIMARY KEY NOT NULL, "
+                    "newest_epoch BIGINT NOT NULL, applied_at BIGINT NOT NULL, lag_p50_ms BIGINT NOT NULL, lag_p99_ms BIGINT NOT NULL, "
+                    "lag_max_ms BIGINT NOT NULL, rows_applied BIGINT NOT NULL)")
+        cur.execute("REPLACE INTO " + ddl['args']['lagtable'] + " (table_name, newest_epoch, applied_at, lag_p50_ms, lag_p99_ms, "
+                    "lag_max_ms, rows_applied) VALUES " + ", ".join(["(%s)" % ", ".join([db_backend(ddl)['placeholder']] * 7) for r in status_rows]),
+                    [v for r in status_rows for v in r])
+        if (ddl['args']['fastinsert'] is True) or (db_backend(ddl)['autocommit'] is False):
+            conn.commit()
+        db_checkin(cur)
+    except Exception as e:
+        print("!!! Could not write replication lag to '%s'. Error: %s" % (ddl['args']['lagtable'], e))
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True  # A scrape left hanging must not keep the engine from exiting
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would otherwise be printed with the engine's own output
+
+
+def start_metrics_server(ddl):
+    """Serves render_metrics() at http://--metricshost:--metricsport/metrics from a daemon thread, or returns None when --metricsport
+    is 0. Must be started after the worker pool, so worker processes are not forked with the server thread's state.
+    """
+    if ddl['args']['metricsport'] == 0:
+        return None
+    server = MetricsServer((ddl['args']['metricshost'], ddl['args']['metricsport']), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    print("Serving metrics at http://%s:%s/metrics" % (ddl['args']['metricshost'], ddl['args']['metricsport']))
+    return server
+
+
 def simplify_ddl_tables(ddl_tables):
     """Return a simplified dictionary containing original and local table names for quicker navigation during persistence.
     """
@@ -247,34 +1664,126 @@ def simplify_ddl_tables(ddl_tables):
     return tables
 
 
+def get_loaded_table(ddl, table):
+    """Returns the simplified table map for table. With packed DDL, tables are decoded from the pack the first time each process
+    touches them, so startup and worker memory only pay for tables that actually replicate.
+    """
+    if (table not in ddl['loaded']) and ('pack' in ddl):
+        table_name, offset, length = ddl['pack']['tables'][table]
+        ddl['loaded'].update(simplify_ddl_tables([read_ddl_pack_section(ddl['pack']['filename'], ddl['pack'], offset, length)]))
+    return ddl['loaded'][table]
+
+
 def main():
     parser = argparse.ArgumentParser(description="ProrepTK persistence engine")
     parser_required = parser.add_argument_group("required arguments")
     parser_required.add_argument("--input", type=str, required=True, help="input file containing RDBMS specific DDL")
     parser_required.add_argument("--jsondir", type=str, required=True, help="directory containing incoming JSON files")
-    parser.add_argument("--concurrency", type=str, choices=('files', 'rows'), default="rows", help="concurrency strategy (default: rows) NOTE: 'files' is unsafe in some circumstances")
+    parser.add_argument("--concurrency", type=str, choices=('files', 'rows', 'tables'), default="rows",
+                        help="concurrency strategy, 'tables' applies each table's files in order on one process while tables run in parallel "
+                             "(default: rows) NOTE: 'files' is unsafe in some circumstances")
+    parser.add_argument("--backend", type=str, choices=sorted(DB_BACKENDS.keys()), default="mysql",
+                        help="database to replicate into, 'sqlite' creates missing tables itself (default: mysql)")
+    parser.add_argument("--sqlitedb", type=str, default="", help="SQLite database file for --backend sqlite")
     parser.add_argument("--processes", metavar='N', type=int, default=1, help="concurrency factor for multiple cpus (default: 1)")
     parser.add_argument("--processrows", metavar='N', type=int, default=5000, help="rows assigned to each worker process (default: 5000)")
-    parser.add_argument("--delay", metavar='N', type=int, default=5, help="mainloop delay (default: 5)")
+    parser.add_argument("--adaptive", action="store_const", const=True, default=False,
+                        help="size chunks per table from the measured rows/sec instead of using --processrows for every table, and limit the worker "
+                             "processes a table's chunks occupy while its rows slow down under concurrency (default: false)")
+    parser.add_argument("--minrows", metavar='N', type=int, default=500,
+                        help="smallest chunk --adaptive will assign to a worker process (default: 500)")
+    parser.add_argument("--maxrows", metavar='N', type=int, default=50000,
+                        help="largest chunk --adaptive will assign to a worker process (default: 50000)")
+    parser.add_argument("--targetsecs", metavar='SECS', type=float, default=2.0,
+                        help="seconds of work --adaptive aims to give a worker process per chunk (default: 2.0)")
+    parser.add_argument("--workertasks", metavar='N', type=int, default=0,
+                        help="replace each worker process after N tasks, 0 keeps workers for the life of the engine (default: 0)")
+    parser.add_argument("--delay", metavar='N', type=int, default=5, help="mainloop delay, or longest wait for new files with --watch (default: 5)")
     parser.add_argument("--onepass", action="store_const", const=True, default=False, help="only iterate through jsondir 1 time (default: false)")
+    parser.add_argument("--batchrows", metavar='N', type=int, default=500,
+                        help="maximum rows sent in a single multi-row INSERT, 1 disables batching (default: 500)")
+    parser.add_argument("--batchbytes", metavar='N', type=int, default=1048576,
+                        help="maximum approximate bytes of row data sent in a single multi-row INSERT (default: 1048576)")
+    parser.add_argument("--pingidle", metavar='N', type=int, default=30,
+                        help="ping pooled database connections idle for more than N seconds before reuse (default: 30)")
+    parser.add_argument("--coalesce", metavar='N', type=int, default=0,
+                        help="read up to N consecutive files per table and apply only the newest change to each rec_id, 0 disables (default: 0)")
+    parser.add_argument("--deletefiles", metavar='N', type=int, default=500,
+                        help="apply up to N consecutive delete files per table as one set, 1 disables (default: 500)")
+    parser.add_argument("--jsonreader", type=str, choices=('load', 'stream', 'mmap'), default="load",
+                        help="how JSON files are read: 'load' parses the whole file at once, 'stream' parses rows incrementally to bound memory use, "
+                             "'mmap' only indexes row offsets and lets each worker parse its own rows (default: load)")
+    parser.add_argument("--groupcommit", metavar='N', type=int, default=0,
+                        help="commit once per N rows instead of once per statement, removing files only after their rows are committed. Requires "
+                             "'tables' concurrency or --debug, 0 disables (default: 0)")
+    parser.add_argument("--groupsecs", metavar='SECS', type=float, default=1.0,
+                        help="longest a --groupcommit transaction stays open before committing (default: 1.0)")
+    parser.add_argument("--bulkload", action="store_const", const=True, default=False,
+                        help="load insert files, as written by generate_abl_dump, with LOAD DATA LOCAL INFILE, skipping rows already present like "
+                             "--fastinsert. MySQL only, and the server must allow local_infile (default: false)")
     parser.add_argument("--fastinsert", action="store_const", const=True, default=False, help="insert new data with no checks (default: false)")
+    parser.add_argument("--journal", metavar='FILE', type=str, default="",
+                        help="track claimed and persisted files in this append-only journal instead of a .lock file per JSON file, removing "
+                             "persisted files in a batch after each pass. Only one engine may use a jsondir with --journal (default: none)")
     parser.add_argument("--keepjson", action="store_const", const=True, default=False, help="keep JSON files after processing (default: false)")
     parser.add_argument("--debug", action="store_const", const=True, default=False, help="disable all concurrency to allow debugging (default: false)")
+    parser.add_argument("--watch", action="store_const", const=True, default=False,
+                        help="wait for files with inotify instead of sleeping and globbing, Linux only (default: false)")
     parser.add_argument("--globpattern", type=str, default="*.json", help="globbing pattern (default: '*.json')")
+    parser.add_argument("--maxlag", metavar='SECS', type=float, default=0,
+                        help="print an alarm when rows are applied more than SECS after their trigger fired, 0 disables (default: 0)")
+    parser.add_argument("--lagtable", type=str, default="",
+                        help="table to record per-table replication lag in after each pass, created if missing (default: none)")
+    parser.add_argument("--profile", metavar='DIR', type=str, default="",
+                        help="profile every process with cProfile and time the decode, mapping, sql_build, network and commit stages, writing one "
+                             "profile per process to DIR, see merge_profiles.py (default: none)")
+    parser.add_argument("--profilesecs", metavar='SECS', type=int, default=60, help="seconds between writing profiles with --profile (default: 60)")
+    parser.add_argument("--metricsport", metavar='PORT', type=int, default=0,
+                        help="serve Prometheus metrics at http://--metricshost:PORT/metrics, 0 disables (default: 0)")
+    parser.add_argument("--metricshost", type=str, default="127.0.0.1", help="address to serve metrics on (default: 127.0.0.1)")
     parsed_args = vars(parser.parse_args())
 
+    if (parsed_args['backend'] == "sqlite") and (parsed_args['sqlitedb'] == ""):
+        print("--backend sqlite requires --sqlitedb.")
+        sys.exit(1)
+    if (parsed_args['groupcommit'] > 0) and (parsed_args['concurrency'] != "tables") and (parsed_args['debug'] is False):
+        # 'files' tasks are usually one file each, and 'rows' splits files across workers, so neither can share a transaction
+        print("--groupcommit requires --concurrency tables or --debug.")
+        sys.exit(1)
+    if parsed_args['backend'] == "sqlite":
+        import sqlite3
+        if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+            print("--backend sqlite requires SQLite %s or newer, this Python has SQLite %s." % (
+                ".".join([str(v) for v in SQLITE_MIN_VERSION]), sqlite3.sqlite_version))
+            sys.exit(1)
+    if (parsed_args['bulkload'] is True) and (DB_BACKENDS[parsed_args['backend']]['bulk_load'] is None):
+        print("--bulkload is not supported by --backend %s." % parsed_args['backend'])
+        sys.exit(1)
+
     #commented out for quietness
     #print("Loading configuration '%s'" % parsed_args['input'])
-    ddl = read_ddl(parsed_args['input'])
-    ddl = json.loads(ddl)
+    if is_ddl_pack(parsed_args['input']):
+        # Only the header is read here, get_loaded_table() decodes each table's section on first use
+        header = read_ddl_pack_header(parsed_args['input'])
+        ddl = header['ddl']
+        ddl['pack'] = {
+            "filename": parsed_args['input'],
+            "data_start": header['data_start'],
+            "tables": {t[0]: t for t in header['tables']},
+        }
+        ddl['loaded'] = {}
+        ddl['args'] = parsed_args
+    else:
+        ddl = read_ddl(parsed_args['input'])
+        ddl = json.loads(ddl)
 
-    # Load the simplified table map, and reduce the size of ddl, since it will be copied between processes and referenced between threads.
-    #commented out for quietness
-    #print("Adding optimized DDL and run-time configuration")
-    ddl['loaded'] = simplify_ddl_tables(ddl['tables'])
-    ddl['args'] = parsed_args
-    del ddl['tables']
-    del ddl['indexes']
+        # Load the simplified table map, and reduce the size of ddl, since it will be copied between processes and referenced between threads.
+        #commented out for quietness
+        #print("Adding optimized DDL and run-time configuration")
+        ddl['loaded'] = simplify_ddl_tables(ddl['tables'])
+        ddl['args'] = parsed_args
+        del ddl['tables']
+        del ddl['indexes']
 
     #commented out for quietness
     #print("Loaded configuration for database '%s', backend '%s'" % (ddl['config']['dbname'], ddl['config']['rdbms']))
@@ -282,6 +1791,15 @@ def main():
     if ddl['args']['debug'] is True:
         ddl['args']['concurrency'] = "rows"
 
+    watcher = None
+    if ddl['args']['watch'] is True:
+        watcher = inotify_start(ddl)
+    journal_open(ddl)
+    create_tombstone_table(ddl)
+    pool = start_worker_pool(ddl)
+    profile_start(ddl)
+    start_metrics_server(ddl)
+
     while True:  # mainloop
         try:
             results = []
@@ -289,42 +1807,71 @@ def main():
             #print("Mainloop delay for %ss" % ddl['args']['delay'])
             if ddl['args']['debug'] is True:
                 print("DEBUG MODE ON")
-            time.sleep(parsed_args['delay'])
-            #commented out for quietness
-            #print("Globbing '%s/%s'" % (ddl['args']['jsondir'], ddl['args']['globpattern']))
-            files = glob.glob(ddl['args']['jsondir'] + "/" + ddl['args']['globpattern'])
-            files.sort()
+            if watcher is not None:
+                files = inotify_wait(watcher, ddl, parsed_args['delay'])
+            else:
+                time.sleep(parsed_args['delay'])
+                #commented out for quietness
+                #print("Globbing '%s/%s'" % (ddl['args']['jsondir'], ddl['args']['globpattern']))
+                files = glob.glob(ddl['args']['jsondir'] + "/" + ddl['args']['globpattern'])
+                files.sort()
             filecount = len(files)
             fileseq = 0
             print("%s JSON files present." % len(files))
 
-            if ddl['args']['concurrency'] == "files":
-                pool = Pool(processes=ddl['args']['processes'], maxtasksperchild=500)
-                for f in files:
-                    fileseq += 1
-                    if os.path.isfile(f + ".lock"):
-                        print("Skipping locked file '%s'" % f)
-                        continue  # skip files already locked for processing
-                    print("(%s/%s) Processing '%s'." % (fileseq, filecount, f))
-                    results.append(pool.apply_async(process_json_file, [ddl, f, fileseq]))
-                pool.close()
-                pool.join()
-                for r in results:
+            unlocked = []
+            for f in files:
+                if (journal['fd'] is None) and os.path.isfile(f + ".lock"):
+                    print("Skipping locked file '%s'" % f)
+                    continue  # skip files already locked for processing
+                unlocked.append(f)
+            if journal['fd'] is not None:
+                journal_claim(unlocked)
+            record_queue(unlocked)
+            groups = group_json_files(ddl, unlocked)
+
+            if (ddl['args']['concurrency'] == "files") and (pool is not None):
+                for group in groups:
+                    fileseq += len(group)
+                    print("(%s/%s) Processing '%s'." % (fileseq, filecount, "', '".join(group)))
+                    results.append((len(group), pool.apply_async(worker_process_json_files, [group, fileseq])))
+                for files_persisted, r in results:
+                    r.wait()
+                    if r.successful():
+                        record_metrics(r.get(), files_persisted)
                     #commented out for quietness and added pass
                     #print("Persister returned: %s" % r.get())
-                    pass
-
-            elif ddl['args']['concurrency'] == "rows":
-                for f in files:
-                    fileseq += 1
-                    if os.path.isfile(f + ".lock"):
-                        print("Skipping locked file '%s'" % f)
-                        continue  # skip files already locked for processing
-                    print("(%s/%s) Processing '%s'." % (fileseq, filecount, f))
-                    results = process_json_file(ddl, f, fileseq)
+
+            elif (ddl['args']['concurrency'] == "tables") and (pool is not None):
+                for partition in partition_json_groups(groups):
+                    partition_files = sum([len(g) for g in partition])
+                    meta = parse_json_filename(partition[0][0])
+                    print("(%s/%s) Processing %s files for '%s'." % (fileseq + partition_files, filecount, partition_files,
+                                                                     partition[0][0] if meta is None else meta[1]))
+                    results.append((partition_files, pool.apply_async(worker_process_json_partition, [partition, fileseq])))
+                    fileseq += partition_files
+                for files_persisted, r in results:
+                    partition_results = r.get()
+                    record_metrics(partition_results, files_persisted)
+                    summary = {
+                        'table': partition_results[0]['table'] if len(partition_results) > 0 else None,
+                        'rows': sum([p['rows'] for p in partition_results]),
+                        'inserts': sum([p['inserts'] for p in partition_results]),
+                        'updates': sum([p['updates'] for p in partition_results]),
+                        'deletes': sum([p['deletes'] for p in partition_results]),
+                        'skips': sum([p['skips'] for p in partition_results]),
+                    }
+                    print("(%s/%s) Persister summary: %s" % (fileseq, filecount, summary))
+
+            else:
+                if pool is None:  # Rows are persisted by this process, see group_commit_start
+                    group_commit_start(ddl)
+                for group in groups:
+                    fileseq += len(group)
+                    print("(%s/%s) Processing '%s'." % (fileseq, filecount, "', '".join(group)))
+                    results = process_json_files(ddl, group, fileseq, pool)
+                    record_metrics(results, len(group))
                     print("(%s/%s) Persister returned: %s" % (fileseq, filecount, results))
-                    if ddl['args']['debug'] is True:
-                        results = [results]  # Summary must be a list() to work, and debug only returns single dicts
                     summary = {
                         'rows': sum([r['rows'] for r in results]),
                         'inserts': sum([r['inserts'] for r in results]),
@@ -333,15 +1880,28 @@ def main():
                         'skips': sum([r['skips'] for r in results]),
                     }
                     print("(%s/%s) Persister summary: %s" % (fileseq, filecount, summary))
+                group_commit(ddl)
+
+            journal_sweep(ddl)
+            if watcher is not None:
+                inotify_retry(watcher, files)
+            report_lag(ddl)
+            profile_maybe_dump(ddl)
 
             if ddl['args']['onepass'] is True:
                 print("Single pass completed! %s files processed." % (fileseq))
+                if pool is not None:
+                    pool.close()
+                    pool.join()
                 sys.exit(0)
         except Exception as e:
             print("!!! Unhandled exception !!!")
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_tb(exc_traceback, limit=100, file=sys.stdout)
             traceback.print_exception(exc_type, exc_value, exc_traceback, limit=10, file=sys.stdout)
+            group_commit_abort(ddl)
+            if pool is not None:
+                pool.terminate()
             sys.exit(1)
 
 if __name__ == "__main__":